@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013, Maxim Grechkin
+# This file is licensed under GNU General Public License version 3
+# See COPYING for details.
+"""Compare nbformat.reads_json with the lazy loader of ipy_nbreader.
+
+    python benchmarks/bench_load.py [size in MB ...]
+"""
+import sys
+
+from common import load, make_notebook, measure, report
+
+nbformat = load("external.nbformat3")
+ipy_blobs = load("ipy_blobs")
+ipy_nbreader = load("ipy_nbreader")
+
+
+def old_load(s):
+    # what Notebook.__init__ did before the lazy loader
+    nb = nbformat.reads_json(s)
+    blobs = ipy_blobs.get_blob_store()
+    for cell in nb.worksheets[0].cells:
+        for output in cell.get("outputs", []):
+            ipy_blobs.intern_output(output, blobs)
+    return nb
+
+
+def new_load(s, materialize):
+    nb = ipy_nbreader.reads(s)
+    cells = nb.worksheets[0].cells
+    for i in range(int(len(cells) * materialize)):
+        cells[i] = ipy_nbreader.materialize_cell(cells[i])
+    return nb
+
+
+def main():
+    sizes = [float(arg) for arg in sys.argv[1:]] or [5, 50]
+    for size in sizes:
+        s = make_notebook(int(size * 1024 * 1024))
+        print("notebook of %.1f MB" % (len(s) / 1024.0 / 1024.0))
+        report("reads_json + intern images", *measure(lambda: old_load(s)))
+        report("ipy_nbreader, nothing materialized", *measure(lambda: new_load(s, 0)))
+        report("ipy_nbreader, 10% materialized", *measure(lambda: new_load(s, 0.1)))
+        report("ipy_nbreader, all materialized", *measure(lambda: new_load(s, 1)))
+
+
+if __name__ == "__main__":
+    main()
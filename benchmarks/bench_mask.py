@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013, Maxim Grechkin
+# This file is licensed under GNU General Public License version 3
+# See COPYING for details.
+"""Compare websocket payload masking byte by byte (as ABNF.mask did before)
+with the word-wide ABNF.mask, and check that both give the same bytes.
+
+    python benchmarks/bench_mask.py [largest payload in MB]
+"""
+import os
+import sys
+import array
+
+from common import load, measure
+
+websocket3 = load("external.websocket.websocket3")
+
+
+def mask_bytewise(mask_key, data):
+    _m = array.array("B", mask_key)
+    _d = array.array("B", data)
+    for i in range(len(_d)):
+        _d[i] ^= _m[i % 4]
+    return _d.tobytes()
+
+
+def main():
+    largest = float(sys.argv[1]) if len(sys.argv) > 1 else 50
+    sizes = [100, 1000, 10000, 100000, 1000000, 10000000, 50000000]
+    sizes = [size for size in sizes if size <= largest * 1e6]
+    mask_key = os.urandom(4)
+    for size in sizes:
+        data = os.urandom(size)
+        assert websocket3.ABNF.mask(mask_key, data) == mask_bytewise(mask_key, data), size
+        assert websocket3.ABNF.mask(mask_key, websocket3.ABNF.mask(mask_key, data)) == data, size
+        # small payloads are masked many times to get a measurable time
+        number = max(1, 100000 // size)
+        repeat = 1 if size >= 10000000 else 3
+        for label, func in (("byte by byte", mask_bytewise), ("word-wide", websocket3.ABNF.mask)):
+            def run():
+                for _ in range(number):
+                    func(mask_key, data)
+            seconds, _ = measure(run, repeat)
+            per_call = seconds / number
+            print("%-40s %12.1f us %9.1f MB/s" % ("%s, %d bytes" % (label, size), per_call * 1e6, size / per_call / 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013, Maxim Grechkin
+# This file is licensed under GNU General Public License version 3
+# See COPYING for details.
+"""Time the cell lookups the selection and modification handlers do for
+a keystroke: scanning the regions of the view as before, and with the
+position index of ipy_positions. The edit itself is not counted.
+
+    python benchmarks/bench_positions.py [number of cells]
+"""
+import sys
+import time
+
+from common import make_notebook
+from bench_render import Region, new_view
+
+
+def scan_input(view, s):
+    """How on_sel_modified and on_modified found the cell before"""
+    for i, reg in enumerate(view.get_regions("inb_input")):
+        if reg.a + 1 <= s.begin() and s.end() <= reg.b - 1:
+            return i
+    return -1
+
+
+def type_text(nbview, cell_index, count, find):
+    view = nbview.view
+    begin, end = nbview.positions.region(cell_index, "inb_input")
+    caret = begin + 1
+    elapsed = 0
+    for _ in range(count):
+        view.selection[:] = [Region(caret)]
+        start = time.perf_counter()
+        nbview.positions.active = find(caret)
+        elapsed += time.perf_counter() - start
+        view.insert(None, caret, "x")
+        caret += 1
+        view.selection[:] = [Region(caret)]
+        start = time.perf_counter()
+        # on_modified, then on_selection_modified
+        find(caret)
+        find(caret)
+        elapsed += time.perf_counter() - start
+    return elapsed / count
+
+
+def main():
+    cells = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    json_text = make_notebook(cells * 2500, image_share=0)
+    count = 200
+    for label in ("scan regions", "position index"):
+        nbview = new_view(json_text)
+        nbview.draw_notebook(None)
+        view, positions = nbview.view, nbview.positions
+        if label == "scan regions":
+            def find(pos):
+                return scan_input(view, Region(pos))
+        else:
+            def find(pos):
+                return positions.find_input(pos, pos)
+        seconds = type_text(nbview, len(nbview.cells) // 2, count, find)
+        print("%-40s %9.1f us" % ("%s, %d cells, per keystroke" % (label, len(nbview.cells)), seconds * 1e6))
+    print("index rebuilds: %d, catch-ups: %d" % (positions.rebuilds, positions.catch_ups))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013, Maxim Grechkin
+# This file is licensed under GNU General Public License version 3
+# See COPYING for details.
+"""Compare NotebookNode with the slotted records of ipy_records: memory
+held by many outputs, and the attribute accesses done on the hot paths.
+
+    python benchmarks/bench_records.py [number of outputs]
+"""
+import sys
+import timeit
+import tracemalloc
+
+from common import load
+
+nbformat = load("external.nbformat3")
+ipy_records = load("ipy_records")
+
+
+def make_outputs(new_output, count):
+    outputs = []
+    for i in range(count):
+        if i % 3:
+            outputs.append(new_output("stream", "line %d\n" % i, stream="stdout"))
+        else:
+            outputs.append(new_output("pyout", "%d" % i, prompt_number=i))
+    return outputs
+
+
+def memory(new_output, count):
+    tracemalloc.start()
+    outputs = make_outputs(new_output, count)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del outputs
+    return size
+
+
+def access(output, cell, number):
+    def read():
+        output.text
+        output.output_type
+        cell.outputs
+        cell.prompt_number
+
+    def write():
+        cell.prompt_number = 1
+        output.text = "x"
+    return (timeit.timeit(read, number=number) / number / 4,
+            timeit.timeit(write, number=number) / number / 2)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print("%d outputs" % count)
+    for label, new_output in [("NotebookNode", nbformat.new_output),
+                              ("OutputRecord", ipy_records.new_output)]:
+        size = memory(new_output, count)
+        print("%-40s %9.1f MB %6d bytes/output" % (label + " memory", size / 1e6, size // count))
+
+    number = 200000
+    node_cell = nbformat.new_code_cell(input="x = 1", prompt_number=1)
+    node_output = nbformat.new_output("stream", "text\n", stream="stdout")
+    record_cell = ipy_records.new_code_cell(input="x = 1")
+    record_cell.prompt_number = 1
+    record_output = ipy_records.new_output("stream", "text\n", stream="stdout")
+    for label, output, cell in [("NotebookNode", node_output, node_cell),
+                                ("OutputRecord/CellRecord", record_output, record_cell)]:
+        read, write = access(output, cell, number)
+        print("%-40s %9.1f ns/read %6.1f ns/write" % (label + " attributes", read * 1e9, write * 1e9))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013, Maxim Grechkin
+# This file is licensed under GNU General Public License version 3
+# See COPYING for details.
+"""Compare rendering a notebook cell by cell (an insert and add_regions
+call per piece) with NotebookView.draw_notebook, which fills the buffer
+with one insert, with and without virtual rendering. Runs against a stub
+of the sublime module whose view keeps its regions up to date on every
+edit, as Sublime Text does.
+
+    python benchmarks/bench_render.py [number of cells]
+"""
+import sys
+import types
+
+from common import make_notebook, measure, report
+
+
+class Region(object):
+    def __init__(self, a, b=None):
+        self.a = a
+        self.b = a if b is None else b
+
+    def begin(self):
+        return min(self.a, self.b)
+
+    def end(self):
+        return max(self.a, self.b)
+
+    def size(self):
+        return abs(self.b - self.a)
+
+    def empty(self):
+        return self.a == self.b
+
+    def contains(self, x):
+        if isinstance(x, Region):
+            return self.begin() <= x.begin() and x.end() <= self.end()
+        return self.begin() <= x <= self.end()
+
+
+class Selection(list):
+    def add(self, region):
+        self.append(region)
+
+
+class View(object):
+    def __init__(self):
+        self.text = ""
+        self.regions = {}
+        self.selection = Selection()
+        self.changes = 0
+
+    def size(self):
+        return len(self.text)
+
+    def substr(self, region):
+        if isinstance(region, int):
+            return self.text[region:region + 1]
+        return self.text[region.begin():region.end()]
+
+    def insert(self, edit, pos, text):
+        self.changes += 1
+        n = len(text)
+        self.text = self.text[:pos] + text + self.text[pos:]
+        for regions in self.regions.values():
+            for r in regions:
+                # a region grows with text inserted inside it, and is pushed
+                # along by text inserted at or before its start
+                if r.a >= pos:
+                    r.a += n
+                    r.b += n
+                elif r.b > pos:
+                    r.b += n
+        return n
+
+    def erase(self, edit, region):
+        self.changes += 1
+        x, y = region.begin(), region.end()
+        n = y - x
+        self.text = self.text[:x] + self.text[y:]
+        for regions in self.regions.values():
+            for r in regions:
+                r.a = r.a - n if r.a >= y else min(r.a, x)
+                r.b = r.b - n if r.b >= y else min(r.b, x)
+
+    def replace(self, edit, region, text):
+        self.erase(edit, region)
+        if text:
+            self.insert(edit, region.begin(), text)
+
+    def get_regions(self, key):
+        return [Region(r.a, r.b) for r in self.regions.get(key, [])]
+
+    def add_regions(self, key, regions, *args):
+        self.regions[key] = sorted((Region(r.a, r.b) for r in regions), key=Region.begin)
+
+    def erase_regions(self, key):
+        self.regions.pop(key, None)
+
+    def set_read_only(self, value):
+        pass
+
+    def sel(self):
+        return self.selection
+
+    def show_at_center(self, pos):
+        pass
+
+    def visible_region(self):
+        return Region(0, min(len(self.text), 4000))
+
+    def change_count(self):
+        return self.changes
+
+    def run_command(self, name, args=None):
+        pass
+
+
+settings = {"virtual_render_threshold": 0}
+
+
+def install_stub():
+    sublime = types.ModuleType("sublime")
+    for i, name in enumerate(["HIDDEN", "DRAW_EMPTY", "DRAW_NO_FILL", "DRAW_NO_OUTLINE",
+                              "INHIBIT_WORD_COMPLETIONS", "INHIBIT_EXPLICIT_COMPLETIONS"]):
+        setattr(sublime, name, 1 << i)
+    sublime.Region = Region
+    sublime.set_timeout = lambda callback, delay=0: None
+    sublime.set_timeout_async = sublime.set_timeout
+    sublime.load_settings = lambda name: settings
+    sublime.status_message = lambda message: None
+    sys.modules["sublime"] = sublime
+
+
+install_stub()
+from common import load  # noqa: E402 (the stub has to be in place first)
+
+ipy_connection = load("ipy_connection")
+ipy_view = load("ipy_view")
+ipy_positions = load("ipy_positions")
+
+
+def new_view(json_text):
+    nbview = ipy_view.NotebookView.__new__(ipy_view.NotebookView)
+    nbview.view = View()
+    nbview.positions = ipy_positions.PositionIndex(nbview.view)
+    nbview.notebook = ipy_connection.Notebook(json_text)
+    nbview.cells = []
+    nbview.modified = False
+    nbview.closed = True
+    nbview.virtual = False
+    nbview.expanded = set()
+    nbview.watching_viewport = False
+    return nbview
+
+
+def draw_per_cell(nbview):
+    """What draw_notebook did before the buffer was built in one go"""
+    nbview.cells = []
+    for i in range(nbview.notebook.cell_count):
+        nbview.insert_cell_field(None, i)
+        cell_view = nbview.create_cell_view(i, nbview.view, nbview.notebook.get_cell(i))
+        nbview.cells.append(cell_view)
+    for cell_view in nbview.cells:
+        cell_view.draw(None)
+
+
+def draw_bulk(nbview):
+    settings["virtual_render_threshold"] = 0
+    nbview.draw_notebook(None)
+
+
+def draw_virtual(nbview):
+    settings["virtual_render_threshold"] = 1
+    nbview.draw_notebook(None)
+
+
+def main():
+    cells = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    # about 2.5 KB of JSON per cell without images
+    json_text = make_notebook(cells * 2500, image_share=0)
+    count = new_view(json_text).notebook.cell_count
+    print("%d cells, %.1f MB of JSON" % (count, len(json_text) / 1e6))
+
+    views = {}
+    paths = [("per cell", draw_per_cell), ("bulk", draw_bulk), ("bulk, virtual", draw_virtual)]
+    if cells > 1000:
+        del paths[0]  # takes minutes: every insert shifts all regions after it
+    for label, draw in paths:
+        def run():
+            views[label] = nbview = new_view(json_text)
+            draw(nbview)
+        seconds, peak = measure(run, repeat=1 if label == "per cell" else 3)
+        report("render " + label, seconds, peak)
+
+    new = views["bulk"].view
+    if "per cell" in views:
+        old = views["per cell"].view
+        same = old.text == new.text and all(
+            [(r.a, r.b) for r in old.get_regions(key)] == [(r.a, r.b) for r in new.get_regions(key)]
+            for key in ("inb_cells", "inb_input", "inb_output"))
+        print("same buffer and regions: %s" % same)
+    print("buffer size: %.1f MB, virtual: %.1f MB" % (len(new.text) / 1e6, len(views["bulk, virtual"].view.text) / 1e6))
+
+
+if __name__ == "__main__":
+    main()
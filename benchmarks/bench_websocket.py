@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013, Maxim Grechkin
+# This file is licensed under GNU General Public License version 3
+# See COPYING for details.
+"""Receive throughput of the websocket readers from a loopback server:
+WebSocket.recv with the old concatenating reads and with the read buffer,
+and the frame parser of ipy_ioloop fed by recv (as before) and reading
+with recv_into.
+
+    python benchmarks/bench_websocket.py [MB per run]
+"""
+import sys
+import time
+import json
+import base64
+import socket
+import struct
+import hashlib
+import threading
+
+from common import load
+
+websocket3 = load("external.websocket.websocket3")
+ipy_ioloop = load("ipy_ioloop")
+
+
+def make_frame(payload):
+    length = len(payload)
+    if length < 126:
+        header = struct.pack("!BB", 0x81, length)
+    elif length < 65536:
+        header = struct.pack("!BBH", 0x81, 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x81, 127, length)
+    return header + payload
+
+
+def make_message(size):
+    """An iopub message about size bytes long, like a display_data with a png"""
+    png = base64.b64encode(b"\x89PNG" * (size // 5 + 1))[:size].decode("ascii")
+    return json.dumps({"header": {"msg_type": "display_data"}, "parent_header": {},
+                       "content": {"data": {"image/png": png}}}).encode("utf-8")
+
+
+def serve(frames, count):
+    """Start a server that answers the handshake, then sends count frames
+    (repeating the list) to each connection; return its port"""
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(5)
+
+    def handle(conn):
+        request = b""
+        while b"\r\n\r\n" not in request:
+            request += conn.recv(4096)
+        key = [line.split(":", 1)[1].strip() for line in request.decode().split("\r\n")
+               if line.lower().startswith("sec-websocket-key")][0]
+        accept = base64.b64encode(hashlib.sha1((key + "258EAFA5-E914-47DA-95CA-C5AB0DC85B11").encode()).digest())
+        conn.sendall(b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                     b"Sec-WebSocket-Accept: " + accept + b"\r\n\r\n")
+        for i in range(count):
+            conn.sendall(frames[i % len(frames)])
+        conn.close()
+
+    def accept():
+        while True:
+            conn, _ = server.accept()
+            threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    return server.getsockname()[1]
+
+
+class ConcatenatingWebSocket(websocket3.WebSocket):
+    """How WebSocket read before the read buffer"""
+    def _recv(self, bufsize):
+        data = self.sock.recv(bufsize)
+        if not data:
+            raise websocket3.WebSocketConnectionClosedException()
+        return data
+
+    def _recv_strict(self, bufsize):
+        remaining = bufsize
+        data = b""
+        while remaining:
+            data += self._recv(remaining)
+            remaining = bufsize - len(data)
+        return data
+
+    def _recv_line(self):
+        line = []
+        while True:
+            c = self._recv(1)
+            line.append(c)
+            if c == b"\n":
+                break
+        return b"".join(line).decode("utf-8")
+
+
+class CopyingFrameParser(object):
+    """How ipy_ioloop parsed frames before the read buffer"""
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer += data
+        messages = []
+        while True:
+            buf = self.buffer
+            if len(buf) < 2:
+                break
+            length = buf[1] & 0x7f
+            pos = 2
+            if length == 0x7e:
+                if len(buf) < 4:
+                    break
+                length = struct.unpack_from("!H", buf, 2)[0]
+                pos = 4
+            elif length == 0x7f:
+                if len(buf) < 10:
+                    break
+                length = struct.unpack_from("!Q", buf, 2)[0]
+                pos = 10
+            if len(buf) < pos + length:
+                break
+            opcode = buf[0] & 0xf
+            payload = bytes(buf[pos:pos+length])
+            del buf[:pos+length]
+            messages.append((opcode, payload))
+        return messages
+
+
+def read_blocking(cls, port, count):
+    sock = cls()
+    sock.connect("ws://127.0.0.1:%d/" % port)
+    for _ in range(count):
+        json.loads(sock.recv())
+
+
+def read_parser(buffered, port, count):
+    ws = websocket3.WebSocket()
+    ws.connect("ws://127.0.0.1:%d/" % port)
+    sock = ws.sock
+    received = 0
+    if buffered:
+        parser = ipy_ioloop.FrameParser()
+        messages = parser.feed(ws.take_buffered())
+        while True:
+            for opcode, payload in messages:
+                json.loads(str(payload, "utf-8"))
+                received += 1
+            if received == count:
+                break
+            parser.recv_from(sock)
+            messages = parser.messages()
+    else:
+        parser = CopyingFrameParser()
+        messages = parser.feed(ws.take_buffered())
+        while True:
+            for opcode, payload in messages:
+                json.loads(payload.decode("utf-8"))
+                received += 1
+            if received == count:
+                break
+            messages = parser.feed(sock.recv(ipy_ioloop.READ_SIZE))
+
+
+def main():
+    megabytes = float(sys.argv[1]) if len(sys.argv) > 1 else 100
+    for size in (1000, 65536, 1000000, 5000000):
+        frames = [make_frame(make_message(size))]
+        count = max(1, int(megabytes * 1e6 / len(frames[0])))
+        total = count * len(frames[0])
+        port = serve(frames, count)
+        for label, read in (("recv, concatenating", lambda: read_blocking(ConcatenatingWebSocket, port, count)),
+                            ("recv, read buffer", lambda: read_blocking(websocket3.WebSocket, port, count)),
+                            ("ioloop parser, copying", lambda: read_parser(False, port, count)),
+                            ("ioloop parser, recv_into", lambda: read_parser(True, port, count))):
+            start = time.perf_counter()
+            read()
+            seconds = time.perf_counter() - start
+            print("%-48s %9.1f ms %9.1f MB/s" % ("%s, %d x %d bytes" % (label, count, size),
+                                                 seconds * 1000, total / seconds / 1e6))
+
+
+if __name__ == "__main__":
+    main()
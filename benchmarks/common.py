@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013, Maxim Grechkin
+# This file is licensed under GNU General Public License version 3
+# See COPYING for details.
+"""Helpers shared by the benchmark scripts.
+
+The plugin modules use relative imports, so the repository is loaded as a
+package (under PACKAGE) without Sublime Text.
+"""
+import os
+import sys
+import json
+import time
+import types
+import base64
+import random
+import importlib
+import tracemalloc
+
+PACKAGE = "ipynb_plugin"
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if not hasattr(base64, "encodestring"):
+    # nbformat3 imports the names removed in Python 3.9
+    base64.encodestring = base64.encodebytes
+    base64.decodestring = base64.decodebytes
+
+
+def load(module):
+    """Import a plugin module, e.g. load("ipy_nbreader")"""
+    if PACKAGE not in sys.modules:
+        package = types.ModuleType(PACKAGE)
+        package.__path__ = [ROOT]
+        sys.modules[PACKAGE] = package
+    return importlib.import_module(PACKAGE + "." + module)
+
+
+def make_notebook(size, image_share=0.5, seed=1):
+    """JSON of a notebook of about size bytes; image_share of it are png outputs"""
+    rnd = random.Random(seed)
+    cells = []
+    total = 0
+    while total < size:
+        lines = ["x_%d = %d\n" % (i, rnd.randint(0, 1000)) for i in range(rnd.randint(1, 20))]
+        outputs = [{"output_type": "stream", "stream": "stdout",
+                    "text": ["line %d of the output\n" % i for i in range(rnd.randint(0, 200))]}]
+        if rnd.random() < image_share:
+            png = base64.b64encode(os.urandom(rnd.randint(10000, 60000))).decode("ascii")
+            outputs.append({"output_type": "display_data", "png": png, "metadata": {}})
+        cell = {"cell_type": "code", "collapsed": False, "input": lines, "language": "python",
+                "metadata": {}, "outputs": outputs, "prompt_number": len(cells) + 1}
+        cells.append(cell)
+        total += len(json.dumps(cell))
+        if rnd.random() < 0.2:
+            cells.append({"cell_type": "markdown", "metadata": {},
+                          "source": ["Some *notes* about cell %d\n" % len(cells), "\n", "- one\n", "- two"]})
+    return json.dumps({"metadata": {"name": "benchmark"}, "nbformat": 3, "nbformat_minor": 0,
+                       "worksheets": [{"cells": cells, "metadata": {}}]}, indent=1)
+
+
+def measure(func, repeat=3):
+    """Best wall time over repeat runs and the peak of traced memory"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+
+def report(label, seconds, peak=None):
+    line = "%-40s %9.1f ms" % (label, seconds * 1000)
+    if peak is not None:
+        line += " %9.1f MB peak" % (peak / 1e6)
+    print(line)
@@ -29,7 +29,6 @@ except ImportError:
 
 from urllib.parse import urlparse
 import os
-import array
 import struct
 import uuid
 import hashlib
@@ -208,6 +207,22 @@ _HEADERS_TO_CHECK = {
     }
 
 
+# size of the buffer the frames are read into
+RECV_BUFFER_SIZE = 65536
+
+# payloads from this size on are masked a lane at a time with
+# bytes.translate, smaller ones as a single integer
+_MASK_LANES_SIZE = 16384
+_xor_tables = {}
+
+
+def _xor_table(k):
+    table = _xor_tables.get(k)
+    if table is None:
+        table = _xor_tables[k] = bytes(b ^ k for b in range(256))
+    return table
+
+
 class ABNF(object):
     """
     ABNF frame class.
@@ -315,12 +330,20 @@ class ABNF(object):
 
         data: data to mask/unmask.
         """
-        _m = array.array("B", mask_key)
-        _d = array.array("B", data)
-        for i in range(len(_d)):
-            _d[i] ^= _m[i % 4]
-
-        return _d.tobytes()
+        length = len(data)
+        if length < _MASK_LANES_SIZE:
+            # xor the payload as one big integer with the key repeated to
+            # its length, instead of byte by byte in Python
+            key = (bytes(mask_key) * (length // 4 + 1))[:length]
+            masked = int.from_bytes(data, "big") ^ int.from_bytes(key, "big")
+            return masked.to_bytes(length, "big")
+        # every fourth byte is xored with the same key byte: translate
+        # each of the four lanes through a table of that byte
+        data = bytes(data)
+        masked = bytearray(data)
+        for i in range(4):
+            masked[i::4] = data[i::4].translate(_xor_table(mask_key[i]))
+        return bytes(masked)
 
 
 class WebSocket(object):
@@ -362,6 +385,10 @@ class WebSocket(object):
             self.sock.setsockopt(*opts)
         self.sslopt = sslopt
         self.get_mask_key = get_mask_key
+        # bytes received but not read yet are _rbuf[_rstart:_rend]
+        self._rbuf = bytearray(RECV_BUFFER_SIZE)
+        self._rstart = 0
+        self._rend = 0
 
     def fileno(self):
         return self.sock.fileno()
@@ -680,29 +707,79 @@ class WebSocket(object):
         self.connected = False
         self.sock.close()
 
-    def _recv(self, bufsize):
-        bytes = self.sock.recv(bufsize)
-        if not bytes:
+    def _recv_into(self, view):
+        n = self.sock.recv_into(view)
+        if not n:
             raise WebSocketConnectionClosedException()
-        return bytes
+        return n
+
+    def _fill(self):
+        """Receive more bytes into the read buffer, making room if needed"""
+        buf = self._rbuf
+        if self._rend == len(buf):
+            if self._rstart:
+                # move the bytes not read yet to the front
+                pending = self._rend - self._rstart
+                buf[:pending] = buf[self._rstart:self._rend]
+                self._rstart, self._rend = 0, pending
+            else:
+                buf.extend(bytes(len(buf)))
+        self._rend += self._recv_into(memoryview(buf)[self._rend:])
 
-    def _recv_strict(self, bufsize):
-        remaining = bufsize
-        bytes = b""
-        while remaining:
-            bytes += self._recv(remaining)
-            remaining = bufsize - len(bytes)
+    def _consume(self, n):
+        self._rstart += n
+        if self._rstart == self._rend:
+            self._rstart = self._rend = 0
 
-        return bytes
+    def _recv_strict(self, bufsize):
+        """
+        Read exactly bufsize bytes.
+
+        Sizes that fit the read buffer are returned as bytes. Larger ones
+        (frame payloads) are received straight into a bytearray of that
+        size, which is returned as it is.
+        """
+        buf = self._rbuf
+        if bufsize > len(buf):
+            data = bytearray(bufsize)
+            view = memoryview(data)
+            got = self._rend - self._rstart
+            view[:got] = memoryview(buf)[self._rstart:self._rend]
+            self._rstart = self._rend = 0
+            while got < bufsize:
+                got += self._recv_into(view[got:])
+            view.release()
+            return data
+
+        if self._rstart + bufsize > len(buf):
+            pending = self._rend - self._rstart
+            buf[:pending] = buf[self._rstart:self._rend]
+            self._rstart, self._rend = 0, pending
+        while self._rend - self._rstart < bufsize:
+            self._fill()
+        start = self._rstart
+        self._consume(bufsize)
+        return bytes(memoryview(buf)[start:start + bufsize])
 
     def _recv_line(self):
-        line = []
+        buf = self._rbuf
         while True:
-            c = self._recv(1)
-            line.append(c)
-            if c == b"\n":
+            end = buf.find(b"\n", self._rstart, self._rend)
+            if end >= 0:
                 break
-        return b"".join(line).decode("utf-8")
+            self._fill()
+        line = buf[self._rstart:end + 1].decode("utf-8")
+        self._consume(end + 1 - self._rstart)
+        return line
+
+    def take_buffered(self):
+        """
+        Return the bytes received but not read yet, and forget them.
+        For a reader that takes over the socket after the handshake.
+        """
+        data = bytes(self._rbuf[self._rstart:self._rend])
+        self._rstart = self._rend = 0
+        return data
 
 
 class WebSocketApp(object):
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013, Maxim Grechkin
+# This file is licensed under GNU General Public License version 3
+# See COPYING for details.
+import os
+import hashlib
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict
+
+from .external.nbformat3.nbjson import BytesEncoder
+from .ipy_records import Record
+
+BLOB_MEMORY_BUDGET = 32 * 1024 * 1024
+
+# output keys holding (base64 encoded) images
+blob_keys = ["png", "jpeg", "svg"]
+
+
+class BlobRef(object):
+    """Stands for an image payload kept by a BlobStore.
+
+    Identical payloads share the same BlobRef; the payload is dropped from
+    the store once no output refers to it anymore.
+    """
+    __slots__ = ("store", "key", "size", "__weakref__")
+
+    def __init__(self, store, key, size):
+        self.store = store
+        self.key = key
+        self.size = size
+
+    def load(self):
+        return self.store.get(self).decode("utf-8")
+
+    def __len__(self):
+        return self.size
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __repr__(self):
+        return "<BlobRef %s (%d bytes)>" % (self.key[:12], self.size)
+
+
+class BlobEncoder(BytesEncoder):
+    """JSON encoder that writes the payloads of BlobRefs (and Records as dicts)"""
+    def default(self, obj):
+        if isinstance(obj, BlobRef):
+            return obj.load()
+        if isinstance(obj, Record):
+            return obj.to_dict()
+        return BytesEncoder.default(self, obj)
+
+
+class BlobStore(object):
+    """Content-addressed store for image outputs.
+
+    Payloads are keyed by their SHA1. Recently used ones stay in memory
+    within memory_budget bytes, the least recently used are moved to a
+    disk cache and read back when they are needed again.
+    """
+    def __init__(self, memory_budget=BLOB_MEMORY_BUDGET):
+        self.memory_budget = memory_budget
+        self.memory = OrderedDict()  # key -> payload bytes, least recently used first
+        self.memory_bytes = 0
+        self.refs = weakref.WeakValueDictionary()
+        self._watches = {}  # key -> weakref whose callback drops the payload
+        self.on_disk = set()
+        self.cache_dir = None
+        self.hits = 0
+        self.loads = 0
+        self.evictions = 0
+        self._lock = threading.RLock()
+
+    def put(self, payload):
+        """Return the BlobRef for payload (base64 text, as str or bytes)"""
+        data = payload if isinstance(payload, bytes) else payload.encode("utf-8")
+        key = hashlib.sha1(data).hexdigest()
+        with self._lock:
+            ref = self.refs.get(key)
+            if ref is not None:
+                return ref
+            ref = BlobRef(self, key, len(data))
+            self._watches[key] = weakref.ref(ref, lambda _, key=key: self._release(key))
+            self.refs[key] = ref
+            self._remember(key, data)
+        return ref
+
+    def get(self, ref):
+        with self._lock:
+            data = self.memory.get(ref.key)
+            if data is not None:
+                self.hits += 1
+                self.memory.move_to_end(ref.key)
+            else:
+                self.loads += 1
+                with open(self._path(ref.key), "rb") as f:
+                    data = f.read()
+                self._remember(ref.key, data)
+        return data
+
+    def _remember(self, key, data):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return
+        self.memory[key] = data
+        self.memory_bytes += len(data)
+        while (self.memory_bytes > self.memory_budget) and (len(self.memory) > 1):
+            old_key, old_data = self.memory.popitem(last=False)
+            self.memory_bytes -= len(old_data)
+            if old_key not in self.on_disk:
+                with open(self._path(old_key), "wb") as f:
+                    f.write(old_data)
+                self.on_disk.add(old_key)
+            self.evictions += 1
+
+    def _path(self, key):
+        if self.cache_dir is None:
+            self.cache_dir = tempfile.mkdtemp(prefix="ipynb_blobs_")
+        return os.path.join(self.cache_dir, key)
+
+    def _release(self, key):
+        with self._lock:
+            if key in self.refs:
+                return  # the payload came back in the meantime
+            self._watches.pop(key, None)
+            data = self.memory.pop(key, None)
+            if data is not None:
+                self.memory_bytes -= len(data)
+            if key in self.on_disk:
+                self.on_disk.discard(key)
+                try:
+                    os.remove(self._path(key))
+                except OSError:
+                    pass
+
+    def export_file(self, ref, extension):
+        """Write the decoded image to a file for an external viewer"""
+        import base64
+        data = self.get(ref)
+        if extension != "svg":
+            data = base64.b64decode(data)
+        path = self._path(ref.key) + "." + extension
+        if not os.path.exists(path):
+            with open(path, "wb") as f:
+                f.write(data)
+        return path
+
+    def stats(self):
+        return {
+            "blobs": len(self.refs),
+            "blobs_in_memory": len(self.memory),
+            "blob_memory_bytes": self.memory_bytes,
+            "blobs_on_disk": len(self.on_disk),
+            "blob_loads_from_disk": self.loads,
+            "blob_evictions": self.evictions,
+        }
+
+
+def intern_output(output, store):
+    """Replace the image payloads of an output node by BlobRefs"""
+    for key in blob_keys:
+        value = output.get(key)
+        if isinstance(value, (str, bytes)):
+            output[key] = store.put(value)
+    return output
+
+
+def hydrate_output(output):
+    """Copy of the output node with the payloads of its BlobRefs, or the node
+    itself if it has none"""
+    refs = [key for key in blob_keys if isinstance(output.get(key), BlobRef)]
+    if not refs:
+        return output
+    result = output.__class__(output)
+    for key in refs:
+        result[key] = output[key].load()
+    return result
+
+
+_store = None
+
+
+def get_blob_store():
+    """Return the BlobStore shared by all notebooks"""
+    global _store
+    if _store is None:
+        _store = BlobStore()
+    return _store
@@ -5,28 +5,43 @@
 import json
 import uuid
 
-from time import sleep
+import time
 import threading
 import queue
+import tempfile
+import hashlib
 
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict
+from contextlib import contextmanager
 
 import re
 import sys
 import _thread
 from .external import nbformat3 as nbformat
-from .external.websocket import websocket3 as websocket
 from .external.websocket.websocket3 import *
-from urllib.request import urlopen, Request, ProxyHandler, build_opener, install_opener, HTTPCookieProcessor
+from . import ipy_http, ipy_ioloop, ipy_outputs, ipy_blobs, ipy_nbwriter, ipy_nbreader, ipy_records, ipy_latency, ipy_journal
+from .ipy_outputs import OutputStore, render_output, compact_stream_text
+from urllib.request import ProxyHandler, build_opener, install_opener, HTTPCookieProcessor
 from urllib.parse import urlparse, urlencode
+from urllib.error import HTTPError
 from http.cookiejar import CookieJar
 
+cookies = CookieJar()
+
+
 def install_proxy_opener():
     global cookies
     cookies=CookieJar()
     proxy = ProxyHandler({})
     opener = build_opener(proxy, HTTPCookieProcessor(cookies))
     install_opener(opener)
+    ipy_http.close_clients()
+
+def get_http_client(url):
+    return ipy_http.get_client(url, cookies)
+
+def http_request(url, data=None, method=None, headers=None):
+    return get_http_client(url).request(url, data, method, headers)
 
 def create_uid():
     return str(uuid.uuid4())
@@ -35,11 +50,10 @@ def get_notebooks(baseurl, psswd=None):
     try:
         if psswd!=None:
             target_url=baseurl+'''/login?next=%2F'''
-            urlopen(target_url, data=urlencode({'password': psswd}).encode('utf8'))
+            http_request(target_url, data=urlencode({'password': psswd}).encode('utf8'),
+                         headers={"Content-Type": "application/x-www-form-urlencoded"})
         target_url = baseurl    +"/notebooks"
-        req = urlopen(target_url)
-        encoding = req.headers.get_content_charset()
-        body = req.readall().decode(encoding)
+        body = http_request(target_url).text()
         if '<input type="password" name="password" id="password_input">' in body:
             return 'psswd'
         data = json.loads(body)
@@ -51,9 +65,7 @@ def get_notebooks(baseurl, psswd=None):
 
 def create_new_notebook(baseurl):
     try:
-        req = urlopen(baseurl + "/new")
-        encoding = req.headers.get_content_charset()
-        body = req.readall().decode(encoding)
+        body = http_request(baseurl + "/new").text()
         import re
         match =  re.search("data-notebook-id=(.*)", body)
         nbid = match.groups()[0]
@@ -72,14 +84,15 @@ def convert_mime_types(obj, content):
     if "text/html" in content:
         obj.html = content["text/html"]
 
+    blobs = ipy_blobs.get_blob_store()
     if "image/svg+xml" in content:
-        obj.svg = content["image/svg+xml"]
+        obj.svg = blobs.put(content["image/svg+xml"])
 
     if "image/png" in content:
-        obj.png = content["image/png"]
+        obj.png = blobs.put(content["image/png"])
 
     if "image/jpeg" in content:
-        obj.jpeg = content["image/jpeg"]
+        obj.jpeg = blobs.put(content["image/jpeg"])
 
     if "text/latex" in content:
         obj.latex = content["text/latex"]
@@ -95,18 +108,209 @@ def convert_mime_types(obj, content):
 
 class Notebook(object):
     def __init__(self, s):
-        self._notebook = nbformat.reads_json(s)
+        # cells are converted to NotebookNodes only when they are first used
+        self._notebook = ipy_nbreader.reads(s)
         if len(self._notebook.worksheets) == 0:
              # probably have an empty notebook, create a worksheet
             self._notebook.worksheets.append(nbformat.new_worksheet(cells = [nbformat.new_code_cell(input="")]))
         self._cells = self._notebook.worksheets[0].cells
         self.notebook_view = None
+        self.output_head_size = ipy_outputs.OUTPUT_HEAD_SIZE
+        self.output_tail_size = ipy_outputs.OUTPUT_TAIL_SIZE
+        self.save_spilled_outputs = True
+        self._stores = {}
+        self._indexes = None  # id of a cell node -> its index, built when needed
+        # bumped on every change, compared with the revision that was last saved
+        self.revision = 0
+        self.saved_revision = 0
+        self.saved_hash = None
+        self.journal = None
+        self.journal_output_size = ipy_journal.OUTPUT_SIZE
+        # held while a change is made and journaled, so that a snapshot
+        # has either both or neither
+        self.lock = threading.RLock()
+
+    def touch(self):
+        self.revision += 1
+
+    @property
+    def dirty(self):
+        return self.revision != self.saved_revision
+
+    def mark_saved(self, revision, content_hash):
+        with self.lock:
+            self.saved_revision = revision
+            self.saved_hash = content_hash
+            if (self.journal is not None) and (self.revision == revision):
+                # the server has every change, the journal can start over
+                self.journal.reset(content_hash)
+
+    def compact_journal(self, force=False):
+        """Replace the records of the journal by a snapshot once they grew
+        past its compact_bytes (or right away, with force).
+
+        The snapshot is taken here, with large and spilled outputs left out,
+        and written on another thread.
+        """
+        journal = self.journal
+        if (journal is None) or not (force or journal.wants_compaction()):
+            return
+        with self.lock:
+            snapshot = self.export(lazy=True, for_journal=True)
+            journal.begin_compaction()
+        _thread.start_new_thread(journal.finish_compaction, (snapshot,))
+
+    def content_hash(self, encoding="utf-8"):
+        """SHA1 of the notebook as it would be saved"""
+        digest = hashlib.sha1()
+        for chunk in ipy_nbwriter.iter_chunks(self.export(lazy=True), encoding=encoding):
+            digest.update(chunk)
+        return digest.hexdigest()
+
+    def cell_index(self, node):
+        if self._indexes is None:
+            self._indexes = {id(cell): i for i, cell in enumerate(self._cells)}
+        i = self._indexes.get(id(node), -1)
+        if (i < 0) or (self._cells[i] is not node):
+            return -1
+        return i
+
+    def record(self, op, node, *args):
+        """Add a change of the cell node (or of the notebook, if node is None)
+        to the edit journal"""
+        if self.journal is None:
+            return
+        if node is not None:
+            index = self.cell_index(node)
+            if index < 0:
+                return
+            args = (index,) + args
+        if op == "output":
+            args = args[:-1] + (ipy_journal.journal_output(args[-1], self.journal_output_size),)
+        self.journal.append([op] + list(args))
+
+    def apply_journal(self, records):
+        """Replay the records of an edit journal, return how many were applied"""
+        journal, self.journal = self.journal, None
+        applied = 0
+        try:
+            for record in records:
+                op, args = record[0], record[1:]
+                if op == "insert":
+                    self.create_new_cell(args[0], args[1])
+                elif op == "delete":
+                    self.delete_cell(args[0])
+                elif op == "name":
+                    self.name = args[0]
+                else:
+                    cell = self.get_cell(args[0])
+                    if op == "source":
+                        cell.source = args[1]
+                    elif op == "clear":
+                        cell.clear_outputs()
+                    elif op == "output":
+                        cell._cell.outputs.append(ipy_nbreader.materialize_output(args[1]))
+                        cell.output_store.added(cell._cell.outputs)
+                    elif op == "tail":
+                        last = cell._cell.outputs[-1]
+                        last.text = last.text[:args[1]] + args[2]
+                    elif op == "prompt":
+                        cell._cell.prompt_number = args[1]
+                applied += 1
+        except (IndexError, KeyError, AttributeError) as e:
+            print("Edit journal does not apply from record", applied)
+            print(e)
+        finally:
+            self.journal = journal
+        self.touch()
+        return applied
 
     def __str__(self):
-        return nbformat.writes_json(self._notebook)
+        return "".join(ipy_nbwriter.iter_json(self.export(lazy=True)))
+
+    def write(self, f, encoding="utf-8", digest=None):
+        """Write the notebook JSON to a binary file, return its size"""
+        return ipy_nbwriter.write_json(self.export(lazy=True), f, encoding, digest)
+
+    def snapshot(self):
+        """The revision and the tree to save, taken at the same time"""
+        with self.lock:
+            return self.revision, self.export(lazy=True)
+
+    def export(self, lazy=False, for_journal=False):
+        """The notebook tree to save, with spilled outputs put back in
+        (or replaced by a note, if save_spilled_outputs is off) and images
+        read back from the blob store.
+
+        With lazy, images stay BlobRefs and spilled outputs are iterators
+        reading them from disk, as ipy_nbwriter expects. The cells and their
+        lists of outputs are copied, so the tree can be written on another
+        thread while the notebook changes.
+
+        With for_journal, spilled outputs are replaced by a note and large
+        ones as in the journal records.
+        """
+        worksheets = []
+        for n, worksheet in enumerate(self._notebook.worksheets):
+            cells = []
+            for i, cell in enumerate(worksheet.get("cells", [])):
+                if not ipy_nbreader.is_materialized(cell):
+                    if lazy:
+                        # ipy_nbwriter takes care of the lines of cells not yet converted
+                        cells.append(cell)
+                        continue
+                    cell = self.materialize(i) if n == 0 else ipy_nbreader.materialize_cell(cell)
+                cells.append(self.export_cell(cell, lazy, for_journal))
+            worksheets.append(nbformat.NotebookNode(worksheet, cells=cells))
+        return nbformat.NotebookNode(self._notebook, worksheets=worksheets)
+
+    def export_cell(self, cell, lazy, for_journal=False):
+        if "outputs" not in cell:
+            return cell if lazy else cell.to_node()
+        outputs = cell.outputs
+        store = self.find_output_store(cell)
+        if store is not None:
+            # the store takes the outputs while nothing is spilled or cleared
+            if for_journal or not self.save_spilled_outputs:
+                outputs = store.truncated_outputs(cell)
+            elif lazy:
+                outputs = store.iter_full_outputs(cell)
+            else:
+                outputs = store.full_outputs(cell)
+        if for_journal:
+            outputs = [ipy_journal.journal_output(output, self.journal_output_size) for output in outputs]
+        if lazy:
+            # a copy of the list, outputs keep coming in while it is written
+            if outputs is cell.outputs:
+                outputs = list(outputs)
+            result = cell.to_dict()
+        else:
+            result = cell.to_node()
+            outputs = [ipy_blobs.hydrate_output(output.to_node()) for output in outputs]
+        result["outputs"] = outputs
+        return result
+
+    def get_output_store(self, node):
+        if id(node) not in self._stores:
+            self._stores[id(node)] = (node, OutputStore(self.output_head_size, self.output_tail_size))
+        return self._stores[id(node)][1]
+
+    def find_output_store(self, node):
+        """The output store of node, or None if it was never needed"""
+        return self._stores.get(id(node), (None, None))[1]
+
+    def materialize(self, cell_index):
+        node = self._cells[cell_index]
+        if not ipy_nbreader.is_materialized(node):
+            if self._indexes is not None:
+                del self._indexes[id(node)]
+            node = self._cells[cell_index] = ipy_nbreader.materialize_cell(node)
+            if self._indexes is not None:
+                self._indexes[id(node)] = cell_index
+        return node
 
     def get_cell(self, cell_index):
-        return Cell(self._cells[cell_index])
+        return Cell(self.materialize(cell_index), self)
 
     @property
     def cell_count(self):
@@ -114,17 +318,28 @@ class Notebook(object):
 
     def create_new_cell(self, position, cell_type):
         if cell_type == "code":
-            new_cell = nbformat.new_code_cell(input="")
+            new_cell = ipy_records.new_code_cell(input="")
         elif (cell_type == "markdown") or (cell_type == "raw"):
-            new_cell = nbformat.new_text_cell(cell_type, source="")
+            new_cell = ipy_records.new_text_cell(cell_type, source="")
 
         if position < 0:
             position = len(self._cells)
-        self._cells.insert(position, new_cell)
-        return Cell(new_cell)
+        with self.lock:
+            self._cells.insert(position, new_cell)
+            self._indexes = None
+            self.record("insert", None, position, cell_type)
+            self.touch()
+        return Cell(new_cell, self)
 
     def delete_cell(self, cell_index):
-        del self._cells[cell_index]
+        with self.lock:
+            node = self._cells[cell_index]
+            if id(node) in self._stores:
+                self._stores.pop(id(node))[1].close()
+            del self._cells[cell_index]
+            self._indexes = None
+            self.record("delete", None, cell_index)
+            self.touch()
 
     def name():
         doc = "The name property."
@@ -132,84 +347,236 @@ class Notebook(object):
         def fget(self):
             return self._notebook.metadata.name
         def fset(self, value):
-            self._notebook.metadata.name = value
+            if value != self._notebook.metadata.get("name"):
+                with self.lock:
+                    self._notebook.metadata.name = value
+                    self.record("name", None, value)
+                    self.touch()
         return locals()
     name = property(**name())
 
 
 MAX_OUTPUT_SIZE = 5000
+# an unfinished stream line is merged into until it is this long
+OPEN_LINE_SIZE = 8192
+
+
+_detached_lock = threading.RLock()
 
 
 class Cell(object):
-    def __init__(self, obj):
+    def __init__(self, obj, notebook=None):
         self._cell = obj
+        self.notebook = notebook
         self.runnig = False
         self.cell_view = None
+        # bumped whenever outputs are changed other than by appending or
+        # by changing the last one
+        self.output_generation = 0
+        self._rendered = []
+        self._rendered_key = None
+        self.clear_pending = False
+        self.msg_id = None
 
     @property
     def cell_type(self):
         return self._cell.cell_type
 
+    def touch(self):
+        if self.notebook is not None:
+            self.notebook.touch()
+
+    @property
+    def lock(self):
+        """Held while the cell is changed and the change is journaled"""
+        return self.notebook.lock if self.notebook is not None else _detached_lock
+
+    def record(self, op, *args):
+        if self.notebook is not None:
+            self.notebook.record(op, self._cell, *args)
+
     def source():
         doc = "The source property."
 
         def fget(self):
-            if self.cell_type == "code":
-                return "".join(self._cell.input)
+            if self._cell.cell_type == "code":
+                return self._cell.get("input", "")
             else:
-                return "".join(self._cell.source)
+                return self._cell.get("source", "")
 
         def fset(self, value):
-            if self.cell_type == "code":
-                self._cell.input = value
-            else:
-                self._cell.source = value
+            if value == self.source:
+                return
+            with self.lock:
+                if self._cell.cell_type == "code":
+                    self._cell.input = value
+                else:
+                    self._cell.source = value
+                self.record("source", value)
+                self.touch()
         return locals()
     source = property(**source())
 
+    @property
+    def outputs(self):
+        return self._cell.outputs
+
+    def spilled_store(self):
+        if self.notebook is None:
+            return None
+        store = self.notebook.find_output_store(self._cell)
+        return store if (store is not None) and store.spilled_count else None
+
+    def rendered_outputs(self):
+        """Rendered text of every output, memoized per output node.
+
+        Once outputs were spilled only the head is shown, followed by a
+        placeholder, so that spilling more of them changes nothing here.
+        """
+        outputs = self._cell.outputs
+        key = (self.output_generation, id(outputs))
+        if self._rendered_key != key:
+            self._rendered_key = key
+            self._rendered = []
+        store = self.spilled_store()
+        if store is None:
+            for output in outputs[len(self._rendered):]:
+                self._rendered.append(render_output(output))
+        elif len(self._rendered) <= store.head_count:
+            for output in outputs[len(self._rendered):store.head_count]:
+                self._rendered.append(render_output(output))
+            self._rendered.append(ipy_outputs.SPILLED_OUTPUT_TEXT)
+        return self._rendered
+
     @property
     def output(self):
-        result = []
-        for output in self._cell.outputs:
-            if "text" in output:
-                result.append(output.text)
-            elif "traceback" in output:
-                data = "\n".join(output.traceback)
-                data = re.sub("\x1b[^m]*m", "", data)  # remove escape characters
-                result.append(data)
-                if not data.endswith("\n"):
-                    result.append("\n")
-        result = "".join(result)
+        result = "".join(self.rendered_outputs())
         if len(result) > MAX_OUTPUT_SIZE:
             result = result[:MAX_OUTPUT_SIZE] + "..."
         return result
 
-    def on_output(self, msg_type, content):
-        output = None
-        content = defaultdict(lambda: None, content)  # an easy way to avoid checking all parameters
-        if msg_type == "stream":
-            output = nbformat.new_output(msg_type, content["data"], stream=content["name"])
-        elif msg_type == "pyerr":
-            output = nbformat.new_output(msg_type, traceback=content["traceback"], ename=content["ename"], evalue=content["evalue"])
-        elif msg_type == "pyout":
-            output = nbformat.new_output(msg_type, prompt_number=content["prompt_number"])
-            convert_mime_types(output, content["data"])
-        elif msg_type == "display_data":
-            output = nbformat.new_output(msg_type, prompt_number=content["prompt_number"])
-            convert_mime_types(output, content["data"])
-        else:
-            raise Exception("Unknown msg_type")
+    def outputs_changed(self, index):
+        """Output nodes from index on were modified in place"""
+        store = self.spilled_store()
+        if (store is None) or (index < store.head_count):
+            if index >= len(self._rendered) - 1:
+                # only the last one, the view rewrites just that by itself
+                del self._rendered[index:]
+            else:
+                self.forget_rendered(index)
+        self.touch()
+
+    def forget_rendered(self, index):
+        del self._rendered[index:]
+        self.output_generation += 1
+        self._rendered_key = (self.output_generation, id(self._cell.outputs))
 
-        if output:
-            self._cell.outputs.append(output)
+    @property
+    def output_store(self):
+        if self.notebook is None:
+            return None
+        return self.notebook.get_output_store(self._cell)
+
+    def clear_outputs(self):
+        self.clear_pending = False
+        self.output_generation += 1
+        with self.lock:
+            if self.output_store:
+                self.output_store.clear(self._cell)
+            else:
+                self._cell.outputs = []
+            self.record("clear")
+            self.touch()
+
+    def output_page_count(self):
+        if self.output_store is None:
+            return 1
+        return self.output_store.page_count(self._cell.outputs)
+
+    def read_output_page(self, page):
+        if self.output_store is None:
+            return "".join(self.rendered_outputs())
+        return self.output_store.read_page(self._cell.outputs, page)
+
+    def on_clear_output(self, msg_type, content):
+        if content.get("wait"):
+            # keep the old output until the new one arrives, avoids flicker
+            self.clear_pending = True
+        else:
+            self.clear_outputs()
             if self.cell_view:
                 self.cell_view.update_output()
 
+    def append_stream(self, name, data):
+        """Add stream text, merging it into the last output when it continues
+        an unfinished line (and maybe rewrites it with carriage
+        returns/backspaces).
+
+        The lines finished before are left behind in an output of their own,
+        so what is merged into stays one line long, up to OPEN_LINE_SIZE.
+        """
+        outputs = self._cell.outputs
+        last = outputs[-1] if outputs else None
+        if ((last is None) or (last.get("output_type") != "stream") or
+                (last.get("stream") != name) or ("text" not in last) or last.text.endswith("\n")):
+            return ipy_records.new_output("stream", compact_stream_text(data), stream=name)
+        head, sep, tail = last.text.rpartition("\n")
+        if len(tail) >= OPEN_LINE_SIZE:
+            return ipy_records.new_output("stream", compact_stream_text(data), stream=name)
+        if head:
+            last.text = head + sep
+            self.record("tail", len(last.text), "")
+            self.outputs_changed(len(outputs) - 1)
+            return ipy_records.new_output("stream", compact_stream_text(tail + data), stream=name)
+        last.text = compact_stream_text(tail + data)
+        self.record("tail", 0, last.text)
+        self.outputs_changed(len(outputs) - 1)
+        return None
+
+    def on_output(self, msg_type, content):
+        output = None
+        content = defaultdict(lambda: None, content)  # an easy way to avoid checking all parameters
+        with self.lock:
+            if self.clear_pending:
+                self.clear_outputs()
+            if msg_type == "stream":
+                output = self.append_stream(content["name"] or "stdout", content["data"] or "")
+            elif msg_type == "pyerr":
+                output = ipy_records.new_output(msg_type, traceback=content["traceback"], ename=content["ename"], evalue=content["evalue"])
+            elif msg_type == "pyout":
+                output = ipy_records.new_output(msg_type, prompt_number=content["prompt_number"])
+                convert_mime_types(output, content["data"])
+            elif msg_type == "display_data":
+                output = ipy_records.new_output(msg_type, prompt_number=content["prompt_number"])
+                convert_mime_types(output, content["data"])
+            else:
+                raise Exception("Unknown msg_type")
+
+            if output:
+                self._cell.outputs.append(output)
+                self.record("output", output)
+                self.touch()
+            store = self.output_store
+            if store:
+                spilled = store.added(self._cell.outputs)
+                if spilled and (spilled == store.spilled_count):
+                    # the first spill, the tail is replaced by the placeholder
+                    self.forget_rendered(store.head_count)
+        if self.cell_view:
+            self.cell_view.update_output()
+
     def on_execute_reply(self, msg_id, content):
         self.running = False
         if 'execution_count' in content:
-            self._cell.prompt_number = content['execution_count']
-        self.cell_view.on_execute_reply(msg_id, content)
+            with self.lock:
+                self._cell.prompt_number = content['execution_count']
+                self.record("prompt", content['execution_count'])
+                self.touch()
+        elif (content.get("status") == "aborted") and (self._cell.get("prompt_number") == '*'):
+            # the kernel dropped the request after an error in an earlier cell
+            del self._cell.prompt_number
+        if self.cell_view:
+            self.cell_view.on_execute_reply(msg_id, content)
 
     @property
     def prompt(self):
@@ -218,48 +585,314 @@ class Cell(object):
         else:
             return " "
 
-    def run(self, kernel):
+    def run(self, kernel, reply_callback=None):
+        """Send the cell to the kernel, return the msg_id of the request.
+        reply_callback(msg_id, content) is called after the cell has
+        handled the execute_reply."""
         if self.cell_type != "code":
-            return
+            return None
 
         self._cell.prompt_number = '*'
-        self._cell.outputs = []
+        self.clear_outputs()
         if self.cell_view:
             self.cell_view.update_output()
             self.cell_view.update_prompt_number()
 
-        kernel.run(self.source, output_callback=self.on_output,
-                   execute_reply_callback=self.on_execute_reply)
+        def execute_reply_callback(msg_id, content):
+            self.on_execute_reply(msg_id, content)
+            if reply_callback is not None:
+                reply_callback(msg_id, content)
+        self.msg_id = kernel.run(self.source, output_callback=self.on_output,
+                                 clear_output_callback=self.on_clear_output,
+                                 execute_reply_callback=execute_reply_callback)
+        return self.msg_id
 
 
 output_msg_types = set(["stream", "display_data", "pyout", "pyerr"])
 
+CONNECT_TIMEOUT = 10
+BATCH_LATENCY = 0.05
+MAX_BATCH_SIZE = 1000
+RUN_PIPELINE_DEPTH = 8
+JOURNAL_SIZE = 1000
+JOURNAL_BYTES = 16 * 1024 * 1024
+SAVE_SPOOL_SIZE = 4 * 1024 * 1024
+
+
+class MessageJournal(object):
+    """Ring buffer of the latest raw kernel messages.
+
+    Holds at most max_messages entries and, if max_bytes is set, at most
+    max_bytes of encoded message text. The oldest entries are dropped first.
+    """
+    def __init__(self, max_messages=JOURNAL_SIZE, max_bytes=JOURNAL_BYTES):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.dropped = 0
+        self._entries = deque()
+        self._lock = threading.Lock()
+
+    def append(self, msg, size):
+        with self._lock:
+            self._entries.append((msg, size))
+            self.total_bytes += size
+            while self._entries and ((len(self._entries) > self.max_messages) or
+                                     (self.max_bytes and self.total_bytes > self.max_bytes)):
+                _, old_size = self._entries.popleft()
+                self.total_bytes -= old_size
+                self.dropped += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        with self._lock:
+            return iter([msg for msg, _ in self._entries])
+
+
+COMPLETION_CACHE_SIZE = 256
+_identifier_re = re.compile(r"\w*$")
+
+
+class Completer(object):
+    """Asynchronous tab completion with a cache of the kernel's answers.
+
+    Answers are keyed by the text of the line before the cursor. When the
+    user typed more identifier characters since a cached answer, its matches
+    are filtered instead of asking the kernel again. The cache is dropped
+    whenever the kernel's execution count changes, as running code may
+    define new names. Only the latest request is kept in flight.
+    """
+    def __init__(self, kernel, size=COMPLETION_CACHE_SIZE):
+        self.kernel = kernel
+        self.size = size
+        self.cache = OrderedDict()
+        self.execution_count = None
+        self.pending_msg_id = None
+        self.hits = 0
+        self.misses = 0
+        self.replies = 0
+        self.total_latency = 0.0
+        self.last_latency = None
+        self._lock = threading.Lock()
+
+    def _check_generation(self):
+        if self.execution_count != self.kernel.execution_count:
+            self.cache.clear()
+            self.execution_count = self.kernel.execution_count
+
+    def _find(self, key):
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key][0]
+
+        typed = _identifier_re.search(key).group()
+        for i in range(1, len(typed) + 1):
+            shorter = key[:-i]
+            if shorter not in self.cache:
+                continue
+            matches, matched_text = self.cache[shorter]
+            if matched_text is None:
+                return None
+            token = matched_text + typed[-i:]
+            return [m for m in matches if m.startswith(token)]
+        return None
+
+    def lookup(self, line, cursor_pos):
+        """Return the cached matches for this position or None"""
+        with self._lock:
+            self._check_generation()
+            matches = self._find(line[:cursor_pos])
+            if matches is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return matches
+
+    def request(self, line, cursor_pos, callback):
+        """Ask the kernel for completions, callback(matches) is called from
+        the kernel's message thread once they arrive"""
+        key = line[:cursor_pos]
+        sent = time.time()
+
+        def on_reply(msg_type, content):
+            matches = content.get("matches", [])
+            with self._lock:
+                self.kernel.unregister_callbacks(msg_id)
+                if self.pending_msg_id == msg_id:
+                    self.pending_msg_id = None
+                self.last_latency = time.time() - sent
+                self.total_latency += self.last_latency
+                self.replies += 1
+                self._check_generation()
+                self.cache[key] = (matches, content.get("matched_text"))
+                while len(self.cache) > self.size:
+                    self.cache.popitem(last=False)
+            callback(matches)
+
+        with self._lock:
+            # the user kept typing, nobody waits for the older answer anymore
+            if self.pending_msg_id is not None:
+                self.kernel.unregister_callbacks(self.pending_msg_id)
+            msg_id = self.kernel.request_completions(line, cursor_pos, on_reply)
+            self.pending_msg_id = msg_id
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "completion_hit_rate": "%.1f%%" % (100.0 * self.hits / lookups) if lookups else "n/a",
+            "completion_cache_entries": len(self.cache),
+            "completion_latency_last": "%.3fs" % self.last_latency if self.replies else "n/a",
+            "completion_latency_mean": "%.3fs" % (self.total_latency / self.replies) if self.replies else "n/a",
+        }
+
+
+class SaveWorker(object):
+    """Saves notebooks on a background thread.
+
+    Saves requested while one is running are coalesced: only the latest
+    request is carried out once the running save is done. Requests come
+    from the thread that edits the notebook, which takes the snapshot
+    that is saved.
+    """
+    def __init__(self, kernel):
+        self.kernel = kernel
+        self.pending = None
+        self.running = False
+        self.saves = 0
+        self.skipped = 0
+        self.coalesced = 0
+        self.last_size = None
+        self.last_duration = None
+        self._lock = threading.Lock()
+
+    def request(self, notebook, callback=None):
+        """Save notebook; callback(size, seconds, error) is called on the worker
+        thread, size is None when the content was unchanged. The callbacks of
+        coalesced requests are all called with the result of the save."""
+        snapshot = notebook.snapshot()
+        with self._lock:
+            callbacks = [callback] if callback else []
+            if self.pending is not None:
+                self.coalesced += 1
+                callbacks = self.pending[2] + callbacks
+            self.pending = (notebook, snapshot, callbacks)
+            if self.running:
+                return
+            self.running = True
+        _thread.start_new_thread(self.run, ())
+
+    def run(self):
+        while True:
+            with self._lock:
+                if self.pending is None:
+                    self.running = False
+                    return
+                notebook, snapshot, callbacks = self.pending
+                self.pending = None
+
+            start = time.time()
+            size, error = None, None
+            try:
+                size = self.kernel.save_notebook(notebook, snapshot)
+            except Exception as e:
+                print("Failed to save notebook", self.kernel.notebook_id)
+                print(e)
+                error = e
+            duration = time.time() - start
+            if error is None:
+                if size is None:
+                    self.skipped += 1
+                else:
+                    self.saves += 1
+                    self.last_size = size
+                    self.last_duration = duration
+            for callback in callbacks:
+                callback(size, duration, error)
+
+    def stats(self):
+        return {
+            "saves": self.saves,
+            "saves_skipped_unchanged": self.skipped,
+            "saves_coalesced": self.coalesced,
+            "save_last_size": self.last_size if self.last_size is not None else "n/a",
+            "save_last_duration": "%.3fs" % self.last_duration if self.last_duration is not None else "n/a",
+        }
+
+
+class PhaseTimer(object):
+    """Keeps (and logs) how long the named phases of opening a notebook took"""
+    def __init__(self, label):
+        self.label = label
+        self.phases = {}
+
+    def record(self, phase, seconds):
+        self.phases[phase] = seconds
+        print("%s: %s took %.3fs" % (self.label, phase, seconds))
+
+    @contextmanager
+    def measure(self, phase):
+        start = time.time()
+        yield
+        self.record(phase, time.time() - start)
+
 
 class Kernel(object):
-    def __init__(self, notebook_id, baseurl):
+    def __init__(self, notebook_id, baseurl,
+                 journal_size=JOURNAL_SIZE, journal_bytes=JOURNAL_BYTES,
+                 batch_latency=BATCH_LATENCY, autostart=True):
         self.notebook_id = notebook_id
         self.session_id = create_uid()
         self.baseurl = baseurl
         self.shell = None
         self.iopub = None
 
-        self.shell_messages = []
-        self.iopub_messages = []
+        self.shell_messages = MessageJournal(journal_size, journal_bytes)
+        self.iopub_messages = MessageJournal(journal_size, journal_bytes)
         self.running = False
         self.message_queue = queue.Queue()
+        self.batch_latency = batch_latency
         self.message_callbacks = dict()
-        self.start_kernel()
-        _thread.start_new_thread(self.process_messages, ())
+        self.finished_marks = dict()
+        self._kernel_id = None
+        self.kernel_id_resolved_at = None
+        self.channels_ready = threading.Event()
+        self.connection_generation = 0
+        self.timer = PhaseTimer("notebook " + notebook_id)
+        self.execution_count = None
+        self.completer = Completer(self)
+        self.latency = ipy_latency.LatencyTracker()
         self.status_callback = lambda x: None
         self.encoding = 'utf-8'
+        self.closed = False
+        _thread.start_new_thread(self.process_messages, ())
+        if autostart:
+            self.start_kernel()
 
     @property
     def kernel_id(self):
-        id = self.get_kernel_id()
-        if id is None:
-            self.start_kernel()
-            return self.get_kernel_id()
-        return id
+        if self._kernel_id is None:
+            id = self.get_kernel_id()
+            if id is None:
+                self.start_kernel()
+                if self._kernel_id is not None:
+                    return self._kernel_id
+                id = self.get_kernel_id()
+            self.set_kernel_id(id)
+        return self._kernel_id
+
+    def set_kernel_id(self, kernel_id):
+        self._kernel_id = kernel_id
+        self.kernel_id_resolved_at = time.time() if kernel_id is not None else None
+
+    def invalidate_kernel_id(self):
+        self.set_kernel_id(None)
 
     def get_kernel_id(self):
         notebooks = get_notebooks(self.baseurl)
@@ -268,61 +901,150 @@ class Kernel(object):
                 return nb["kernel_id"]
         raise Exception("notebook_id not found")
 
-    def start_kernel(self):
+    def read_kernel_id(self, body):
+        # the server answers kernel start/restart with {"kernel_id": ..., "ws_url": ...}
+        try:
+            self.set_kernel_id(json.loads(body.decode(self.encoding))["kernel_id"])
+        except (ValueError, KeyError, TypeError):
+            self.invalidate_kernel_id()
+
+    def kernel_request(self, suffix="", data=None, method=None, retry=True):
+        url = self.baseurl + "/kernels/" + self.kernel_id + suffix
+        headers = {"Content-Type": "application/json"} if method else None
+        try:
+            return http_request(url, data, method, headers).read()
+        except HTTPError as e:
+            if e.code != 404:
+                raise
+            # the kernel we knew about is gone, resolve it again
+            self.invalidate_kernel_id()
+            if not retry:
+                raise
+            return self.kernel_request(suffix, data, method, retry=False)
+
+    def start_kernel(self, wait=True):
         url = self.baseurl + "/kernels?notebook=" + self.notebook_id
-        req = urlopen(url, data=b"")  # data="" makes it POST request
-        req.read()
-        self.create_websockets()
+        with self.timer.measure("kernel start"):
+            req = http_request(url, data=b"")  # data="" makes it POST request
+            self.read_kernel_id(req.read())
+        self.create_websockets(wait)
+
+    def start_kernel_async(self):
+        """Start the kernel in the background, status_callback reports when it is ready"""
+        def start():
+            try:
+                self.start_kernel(wait=False)
+            except Exception as e:
+                print("Failed to start the kernel for notebook", self.notebook_id)
+                print(e)
+                self.channels_ready.set()
+                self.status_callback("failed to start")
+        _thread.start_new_thread(start, ())
 
     def restart_kernel(self):
-        url = self.baseurl + "/kernels/" + self.kernel_id + "/restart"
-        req = urlopen(url, data=b"")
-        req.read()
+        self.read_kernel_id(self.kernel_request("/restart", data=b""))
         self.create_websockets()
         self.status_callback("idle")
 
     def interrupt_kernel(self):
-        url = self.baseurl + "/kernels/" + self.kernel_id + "/interrupt"
-        req = urlopen(url, data=bytearray(b""))
-        req.read()
+        self.kernel_request("/interrupt", data=b"")
 
     def shutdown_kernel(self):
-        url = self.baseurl + "/kernels/" + self.kernel_id
-        req = Request(url)
-        req.add_header("Content-Type", "application/json")
-        req.get_method = lambda: "DELETE"
-        data = urlopen(req)
-        data.read()
+        try:
+            self.kernel_request(method="DELETE", retry=False)
+        finally:
+            self.invalidate_kernel_id()
         self.status_callback("closed")
 
+    def close(self):
+        """Close the channels and stop the message thread. The kernel itself
+        keeps running on the server."""
+        self.closed = True
+        self.connection_generation += 1
+        self.running = False
+        for channel in (self.shell, self.iopub):
+            if channel is not None:
+                channel.close()
+        self.shell = None
+        self.iopub = None
+        self.channels_ready.set()
+        self.message_queue.put(None)
+
     def get_notebook(self):
-        req = urlopen(self.notebook_url)
-        try:
-            return Notebook(req.readall().decode(self.encoding))
-        except AttributeError:
-            return Notebook(req.read())
+        with self.timer.measure("notebook fetch"):
+            data = http_request(self.notebook_url).read()
+        with self.timer.measure("notebook parse"):
+            return Notebook(data.decode(self.encoding))
 
     @property
     def notebook_url(self):
         return self.baseurl + "/notebooks/" + self.notebook_id
 
-    def save_notebook(self, notebook):
-        request = Request(self.notebook_url, str(notebook).encode(self.encoding))
-        request.add_header("Content-Type", "application/json")
-        request.get_method = lambda: "PUT"
-        data = urlopen(request)
-        data.read()
+    def save_notebook(self, notebook, snapshot=None):
+        """Save the notebook (or the snapshot taken of it), unless its content
+        is the same as at the last save.
+        Returns the size of the sent document, or None if nothing was sent."""
+        revision, tree = snapshot or notebook.snapshot()
+        digest = hashlib.sha1()
+        # small notebooks are serialized in memory, big ones go through a temporary file
+        with tempfile.SpooledTemporaryFile(SAVE_SPOOL_SIZE) as body:
+            size = ipy_nbwriter.write_json(tree, body, self.encoding, digest)
+            if digest.hexdigest() == notebook.saved_hash:
+                size = None
+            else:
+                body.seek(0)
+                http_request(self.notebook_url, body, "PUT",
+                             {"Content-Type": "application/json"})
+        notebook.mark_saved(revision, digest.hexdigest())
+        return size
 
     def on_iopub_msg(self, msg):
         m = json.loads(msg)
-        self.iopub_messages.append(m)
+        self.iopub_messages.append(m, len(msg))
+        self.trace_message(m)
         self.message_queue.put(m)
 
     def on_shell_msg(self, msg):
         m = json.loads(msg)
-        self.shell_messages.append(m)
+        self.shell_messages.append(m, len(msg))
+        self.trace_message(m)
         self.message_queue.put(m)
 
+    def trace_message(self, m):
+        """Note when the messages of a traced execute_request arrive"""
+        parent_id = m.get("parent_header", {}).get("msg_id")
+        if parent_id not in self.latency.traces:
+            return
+        msg_type = m["header"]["msg_type"]
+        if msg_type == "status":
+            state = m["content"].get("execution_state")
+            if state in ("busy", "idle"):
+                self.latency.event(parent_id, state)
+        elif msg_type in output_msg_types:
+            self.latency.event(parent_id, "output")
+        elif msg_type == "execute_reply":
+            self.latency.event(parent_id, "reply")
+
+    def stats(self):
+        result = {
+            "shell_journal_messages": len(self.shell_messages),
+            "shell_journal_bytes": self.shell_messages.total_bytes,
+            "iopub_journal_messages": len(self.iopub_messages),
+            "iopub_journal_bytes": self.iopub_messages.total_bytes,
+            "journal_dropped": self.shell_messages.dropped + self.iopub_messages.dropped,
+            "pending_callbacks": len(self.message_callbacks),
+            "kernel_id_resolved_at": (time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.kernel_id_resolved_at))
+                                      if self.kernel_id_resolved_at else "never"),
+        }
+        result.update(self.completer.stats())
+        result.update(self.latency.stats())
+        result.update(ipy_blobs.get_blob_store().stats())
+        for phase, seconds in self.timer.phases.items():
+            result["open_" + phase.replace(" ", "_")] = "%.3fs" % seconds
+        for key, value in get_http_client(self.baseurl).stats().items():
+            result["http_" + key] = value
+        return result
+
     def register_callbacks(self, msg_id, output_callback,
                            clear_output_callback=None,
                            execute_reply_callback=None,
@@ -337,39 +1059,115 @@ class Kernel(object):
 
         self.message_callbacks[msg_id] = callbacks
 
-    def process_messages(self):
-        while True:
-            m = self.message_queue.get()
-            content = m["content"]
-            msg_type = m["header"]["msg_type"]
+    def unregister_callbacks(self, msg_id):
+        self.message_callbacks.pop(msg_id, None)
+        self.finished_marks.pop(msg_id, None)
 
-            if ("parent_header" in m) and ("msg_id" in m["parent_header"]):
-                parent_id = m["parent_header"]["msg_id"]
+    def mark_finished(self, msg_id, event):
+        # callbacks of an execute_request are retired only when both the
+        # execute_reply (shell) and the matching idle status (iopub) arrived,
+        # as outputs may still be in flight on iopub after the reply
+        if msg_id not in self.message_callbacks:
+            return
+        marks = self.finished_marks.setdefault(msg_id, set())
+        marks.add(event)
+        if ("execute_reply" in marks) and ("idle" in marks):
+            self.unregister_callbacks(msg_id)
+
+    def next_batch(self):
+        """Wait for the next messages and return them as a list.
+
+        Once a message arrived, whatever else is already queued is taken too.
+        While stream output keeps coming we wait up to batch_latency for more
+        of it, so that a chatty cell is redrawn a few times per second rather
+        than once per line.
+        """
+        m = self.message_queue.get()
+        if m is None:
+            return None  # the kernel was closed
+        batch = [m]
+        deadline = time.time() + self.batch_latency
+        while len(batch) < MAX_BATCH_SIZE:
+            timeout = deadline - time.time()
+            try:
+                if (batch[-1]["header"]["msg_type"] == "stream") and (timeout > 0):
+                    m = self.message_queue.get(timeout=timeout)
+                else:
+                    m = self.message_queue.get_nowait()
+            except queue.Empty:
+                break
+            if m is None:
+                self.message_queue.put(None)
+                break
+            batch.append(m)
+        return batch
+
+    @staticmethod
+    def coalesce_streams(batch):
+        """Merge adjacent stream messages of the same request and stream name"""
+        result = []
+        for m in batch:
+            prev = result[-1] if result else None
+            if ((prev is not None) and (m["header"]["msg_type"] == "stream") and
+                    (prev["header"]["msg_type"] == "stream") and
+                    (m.get("parent_header", {}).get("msg_id") == prev.get("parent_header", {}).get("msg_id")) and
+                    (m["content"].get("name") == prev["content"].get("name"))):
+                if "merged" not in prev:
+                    # do not touch the message kept in the journal
+                    prev = dict(prev, content=dict(prev["content"]), merged=True)
+                    result[-1] = prev
+                prev["content"]["data"] = prev["content"].get("data", "") + m["content"].get("data", "")
             else:
-                parent_id = None
-
-            if msg_type == "status":
-                if "execution_state" in content:
-                    self.status_callback(content["execution_state"])
-
-            elif parent_id in self.message_callbacks:
-                callbacks = self.message_callbacks[parent_id]
-                cb = None
-                if msg_type in output_msg_types:
-                    cb = callbacks["output"]
-                elif (msg_type == "clear_output") and ("clear_output" in callbacks):
-                    cb = callbacks["clear_output"]
-                elif (msg_type == "execute_reply") and ("execute_reply" in callbacks):
-                    cb = callbacks["execute_reply"]
-                elif (msg_type == "set_next_input") and ("set_next_input" in callbacks):
-                    cb = callbacks["set_next_input"]
-                elif (msg_type == "complete_reply") and ("complete_reply" in callbacks):
-                    cb = callbacks["complete_reply"]
-
-                if cb:
-                    cb(msg_type, content)
-
-            self.message_queue.task_done()
+                result.append(m)
+        return result
+
+    def process_messages(self):
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                return
+            for m in self.coalesce_streams(batch):
+                self.dispatch(m)
+            for _ in batch:
+                self.message_queue.task_done()
+
+    def dispatch(self, m):
+        content = m["content"]
+        msg_type = m["header"]["msg_type"]
+
+        if ("parent_header" in m) and ("msg_id" in m["parent_header"]):
+            parent_id = m["parent_header"]["msg_id"]
+        else:
+            parent_id = None
+
+        if (msg_type == "execute_reply") and ("execution_count" in content):
+            self.execution_count = content["execution_count"]
+
+        if msg_type == "status":
+            if "execution_state" in content:
+                self.status_callback(content["execution_state"])
+                if content["execution_state"] == "idle":
+                    self.mark_finished(parent_id, "idle")
+
+        elif parent_id in self.message_callbacks:
+            callbacks = self.message_callbacks[parent_id]
+            cb = None
+            if msg_type in output_msg_types:
+                cb = callbacks["output"]
+            elif (msg_type == "clear_output") and ("clear_output" in callbacks):
+                cb = callbacks["clear_output"]
+            elif (msg_type == "execute_reply") and ("execute_reply" in callbacks):
+                cb = callbacks["execute_reply"]
+            elif (msg_type == "set_next_input") and ("set_next_input" in callbacks):
+                cb = callbacks["set_next_input"]
+            elif (msg_type == "complete_reply") and ("complete_reply" in callbacks):
+                cb = callbacks["complete_reply"]
+
+            if cb:
+                cb(msg_type, content)
+
+            if msg_type == "execute_reply":
+                self.mark_finished(parent_id, "execute_reply")
 
     def create_get_output_callback(self, callback):
         def grab_output(msg_type, content):
@@ -386,7 +1184,10 @@ class Kernel(object):
 
         return grab_output
 
-    def create_websockets(self):
+    def create_websockets(self, wait=True):
+        if self.closed:
+            return
+        self.running = False
         if self.shell is not None:
             self.shell.close()
 
@@ -395,19 +1196,46 @@ class Kernel(object):
 
         url = self.baseurl.replace('http', 'ws') + "/kernels/" + self.kernel_id + "/"
         auth=''.join([c.name+'='+c.value for c in cookies])
-        self.shell = websocket.WebSocketApp(url=url + "shell",
-                                            on_message=lambda ws, msg: self.on_shell_msg(msg),
-                                            on_open=lambda ws: ws.send(auth),
-                                            on_error=lambda ws, err: print(err))
-        self.iopub = websocket.WebSocketApp(url=url + "iopub",
-                                            on_message=lambda ws, msg: self.on_iopub_msg(msg),
-                                            on_open=lambda ws: ws.send(auth),
-                                            on_error=lambda ws, err: print(err))
-
-        _thread.start_new_thread(self.shell.run_forever, ())
-        _thread.start_new_thread(self.iopub.run_forever, ())
-        sleep(1)
-        self.running = True
+
+        # late callbacks of the channels we just closed must not touch the
+        # state of the new ones, hence the generation check
+        self.connection_generation += 1
+        generation = self.connection_generation
+        ready = self.channels_ready
+        ready.clear()
+        opened = set()
+        started = time.time()
+
+        def on_open(ws, name):
+            ws.send(auth)
+            opened.add(name)
+            if (len(opened) == 2) and (self.connection_generation == generation):
+                self.timer.record("channels open", time.time() - started)
+                self.running = True
+                ready.set()
+                self.status_callback("idle")
+
+        def on_close(ws):
+            if self.connection_generation == generation:
+                self.running = False
+                ready.set()
+
+        self.shell = ipy_ioloop.Channel(url=url + "shell",
+                                        on_message=lambda ws, msg: self.on_shell_msg(msg),
+                                        on_open=lambda ws: on_open(ws, "shell"),
+                                        on_error=lambda ws, err: print(err),
+                                        on_close=on_close)
+        self.iopub = ipy_ioloop.Channel(url=url + "iopub",
+                                        on_message=lambda ws, msg: self.on_iopub_msg(msg),
+                                        on_open=lambda ws: on_open(ws, "iopub"),
+                                        on_error=lambda ws, err: print(err),
+                                        on_close=on_close)
+
+        loop = ipy_ioloop.get_loop()
+        loop.connect(self.shell)
+        loop.connect(self.iopub)
+        if wait:
+            ready.wait(CONNECT_TIMEOUT)
 
     def create_message(self, msg_type, content):
         msg = dict(
@@ -422,14 +1250,21 @@ class Kernel(object):
         return msg
 
     def send_shell(self, msg):
+        if not self.running:
+            self.channels_ready.wait(CONNECT_TIMEOUT)
         if not self.running:
             self.create_websockets()
         self.shell.send(json.dumps(msg))
 
-    def get_completitions(self, line, cursor_pos, text="", timeout=1):
+    def request_completions(self, line, cursor_pos, callback, text=""):
         msg = self.create_message("complete_request",
                                   dict(line=line, cursor_pos=cursor_pos, text=text))
         msg_id = msg["header"]["msg_id"]
+        self.message_callbacks[msg_id] = {"complete_reply": callback}
+        self.send_shell(msg)
+        return msg_id
+
+    def get_completitions(self, line, cursor_pos, text="", timeout=1):
         ev = threading.Event()
         matches = []
 
@@ -437,11 +1272,9 @@ class Kernel(object):
             if "matches" in content:
                 matches[:] = content["matches"][:]
             ev.set()
-        callbacks = {"complete_reply": callback}
-        self.message_callbacks[msg_id] = callbacks
-        self.send_shell(msg)
+        msg_id = self.request_completions(line, cursor_pos, callback, text)
         ev.wait(timeout)
-        del self.message_callbacks[msg_id]
+        self.unregister_callbacks(msg_id)
         return matches
 
     def run(self, code, output_callback,
@@ -459,4 +1292,244 @@ class Kernel(object):
                                 clear_output_callback,
                                 execute_reply_callback,
                                 set_next_input_callback)
+        self.latency.start(msg_id)
         self.send_shell(msg)
+        return msg_id
+
+
+class RunBatch(object):
+    """Runs a list of cells, keeping up to depth execute_requests queued in
+    the kernel so it does not wait for a round trip between cells.
+
+    After an error the kernel aborts the requests it has queued. With
+    stop_on_error the cells not sent yet are cancelled, otherwise the
+    aborted cells are sent again once the replies of the requests in flight
+    are in. done_callback(batch) is called when the last reply arrives.
+    """
+    def __init__(self, kernel, cells, stop_on_error=False,
+                 depth=RUN_PIPELINE_DEPTH, done_callback=None):
+        self.kernel = kernel
+        self.pending = deque(cell for cell in cells if cell.cell_type == "code")
+        self.count = len(self.pending)
+        self.stop_on_error = stop_on_error
+        self.depth = max(depth, 1)
+        self.done_callback = done_callback
+        self.in_flight = OrderedDict()
+        # cells being sent (outside the lock) and replies that beat them
+        self.sending = 0
+        self.early_replies = {}
+        self.send_wanted = False
+        self.abandoned = False
+        self.retry = []
+        self.draining = False
+        self.done = False
+        self.ran = 0
+        self.failed = 0
+        self.resent = 0
+        self.cancelled = []
+        self.started = None
+        self.duration = None
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+
+    def start(self):
+        self.started = time.time()
+        self._send()
+
+    def cancel(self, abandon=False):
+        """Drop the cells that were not sent yet, the ones in the kernel
+        queue still run unless abandon is set (the kernel was restarted)"""
+        with self._lock:
+            self._drop_pending()
+            if abandon:
+                self.abandoned = True
+                self.cancelled.extend(self.in_flight.values())
+                self.in_flight.clear()
+        self._finish_if_done()
+
+    def _drop_pending(self):
+        self.cancelled.extend(self.retry)
+        self.cancelled.extend(self.pending)
+        self.retry = []
+        self.pending.clear()
+
+    def _send(self):
+        # one thread sends at a time, so the cells go out in order; a thread
+        # finding another one sending leaves the work to it
+        with self._lock:
+            self.send_wanted = True
+        while True:
+            if not self._send_lock.acquire(False):
+                return
+            try:
+                with self._lock:
+                    self.send_wanted = False
+                self._send_ready()
+            finally:
+                self._send_lock.release()
+            with self._lock:
+                if not self.send_wanted:
+                    break
+        self._finish_if_done()
+
+    def _send_ready(self):
+        while True:
+            with self._lock:
+                if self.done or self.draining or (len(self.in_flight) + self.sending >= self.depth):
+                    return
+                if self.retry:
+                    cell = self.retry.pop(0)
+                elif self.pending:
+                    cell = self.pending.popleft()
+                else:
+                    return
+                self.sending += 1
+            # sending may block on a reconnecting channel, cancel() and the
+            # replies must not wait for it
+            msg_id = None
+            try:
+                msg_id = cell.run(self.kernel, self.on_reply)
+            finally:
+                with self._lock:
+                    self.sending -= 1
+                    early = None
+                    if msg_id is None or self.abandoned:
+                        self.cancelled.append(cell)
+                    else:
+                        self.in_flight[msg_id] = cell
+                        early = self.early_replies.pop(msg_id, None)
+            if early is not None:
+                self.on_reply(msg_id, early)
+
+    def on_reply(self, msg_id, content):
+        with self._lock:
+            cell = self.in_flight.pop(msg_id, None)
+            if cell is None:
+                if self.sending:
+                    # the request is not registered yet
+                    self.early_replies[msg_id] = content
+                return
+            status = content.get("status")
+            if status == "aborted":
+                if self.stop_on_error:
+                    self.cancelled.append(cell)
+                else:
+                    self.retry.append(cell)
+                    self.resent += 1
+            else:
+                self.ran += 1
+                if status == "error":
+                    self.failed += 1
+                    if self.stop_on_error:
+                        self._drop_pending()
+                    elif self.in_flight:
+                        # wait for the aborted replies so the cells are sent
+                        # again in their order
+                        self.draining = True
+            if not (self.in_flight or self.sending):
+                self.draining = False
+        self._send()
+
+    def _finish_if_done(self):
+        with self._lock:
+            if self.done or self.in_flight or self.sending or self.pending or self.retry:
+                return
+            self.done = True
+            self.duration = time.time() - self.started if self.started is not None else 0.0
+        if self.done_callback:
+            self.done_callback(self)
+
+    def summary(self):
+        text = "ran %d of %d cells in %.2fs" % (self.ran, self.count, self.duration or 0.0)
+        if self.failed:
+            text += ", %d failed" % self.failed
+        if self.cancelled:
+            text += ", %d cancelled" % len(self.cancelled)
+        return text
+
+
+class KernelSession(object):
+    """A kernel and its channels shared by the views of a notebook.
+    Replies and outputs go to the callbacks registered for their msg_id,
+    status changes to every attached view.
+
+    Each view has its own copy of the notebook. Only one of them keeps the
+    edit journal, and the saves of all of them are counted so that a view
+    can tell that its copy is older than the one on the server."""
+    def __init__(self, key, kernel):
+        self.key = key
+        self.kernel = kernel
+        self.listeners = []
+        self.last_status = None
+        self.journal_owner = None
+        self.saves = 0
+        kernel.status_callback = self.on_status
+
+    def on_status(self, execution_state):
+        self.last_status = execution_state
+        for callback in list(self.listeners):
+            callback(execution_state)
+
+    def attach(self, status_callback):
+        self.listeners.append(status_callback)
+        if self.last_status is not None:
+            status_callback(self.last_status)
+
+    def detach(self, status_callback):
+        if status_callback in self.listeners:
+            self.listeners.remove(status_callback)
+        return len(self.listeners)
+
+    def claim_journal(self, owner):
+        """Return True if owner may keep the edit journal of the notebook"""
+        if self.journal_owner is None:
+            self.journal_owner = owner
+        return self.journal_owner is owner
+
+    def release_journal(self, owner):
+        if self.journal_owner is owner:
+            self.journal_owner = None
+
+
+class SessionPool(object):
+    """Kernel sessions keyed by (baseurl, notebook_id), counted by the views
+    attached to them. The channels and the message thread of a session are
+    closed when its last view is released."""
+    def __init__(self):
+        self.sessions = {}
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+
+    def acquire(self, baseurl, notebook_id, create_kernel, status_callback):
+        """Return (session, created); create_kernel() makes the kernel of a
+        new session, which the caller is expected to start"""
+        key = (baseurl, notebook_id)
+        with self._lock:
+            session = self.sessions.get(key)
+            created = session is None
+            if created:
+                session = KernelSession(key, create_kernel())
+                self.sessions[key] = session
+                self.created += 1
+            else:
+                self.reused += 1
+            session.attach(status_callback)
+        return session, created
+
+    def release(self, session, status_callback):
+        """Detach a view, return True if the session was closed"""
+        with self._lock:
+            if session.detach(status_callback):
+                return False
+            if self.sessions.get(session.key) is session:
+                del self.sessions[session.key]
+        session.kernel.close()
+        return True
+
+    def stats(self):
+        return {
+            "sessions_open": len(self.sessions),
+            "sessions_created": self.created,
+            "sessions_reused": self.reused,
+        }
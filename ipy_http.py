@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013, Maxim Grechkin
+# This file is licensed under GNU General Public License version 3
+# See COPYING for details.
+import io
+import threading
+import http.client
+from urllib.request import Request
+from urllib.parse import urlparse, urljoin
+from urllib.error import HTTPError
+
+POOL_SIZE = 4
+MAX_REDIRECTS = 5
+
+# errors that mean a kept-alive connection was closed by the server
+_stale_connection_errors = (http.client.BadStatusLine, http.client.CannotSendRequest,
+                            ConnectionResetError, ConnectionAbortedError, BrokenPipeError)
+
+
+def get_origin(url):
+    parsed = urlparse(url)
+    return "%s://%s" % (parsed.scheme, parsed.netloc)
+
+
+class HTTPResponse(object):
+    """Fully read response, the connection is back in the pool once we have it"""
+    def __init__(self, url, status, reason, headers, body):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+    def read(self):
+        return self.body
+
+    def info(self):
+        return self.headers
+
+    def text(self, default_encoding="utf-8"):
+        return self.body.decode(self.headers.get_content_charset() or default_encoding)
+
+
+class HTTPClient(object):
+    """Keep-alive HTTP client for a single server (scheme, host and port).
+
+    At most pool_size connections are open at the same time; idle ones are
+    kept for reuse by the following requests. Cookies are read from and
+    stored into the given cookie jar, like HTTPCookieProcessor does.
+    """
+    def __init__(self, origin, cookies, pool_size=POOL_SIZE, timeout=None):
+        parsed = urlparse(origin)
+        self.origin = origin
+        self.cookies = cookies
+        self.timeout = timeout
+        if parsed.scheme == "https":
+            self.connection_class = http.client.HTTPSConnection
+        else:
+            self.connection_class = http.client.HTTPConnection
+        self.host = parsed.hostname
+        self.port = parsed.port
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self.pool_size = pool_size
+        self.requests = 0
+        self.connections_opened = 0
+        self.connections_reused = 0
+
+    def _checkout(self):
+        self._slots.acquire()
+        with self._lock:
+            if self._idle:
+                self.connections_reused += 1
+                return self._idle.pop(), True
+            self.connections_opened += 1
+        return self.connection_class(self.host, self.port, timeout=self.timeout), False
+
+    def _checkin(self, conn, reusable):
+        if reusable:
+            with self._lock:
+                self._idle.append(conn)
+        else:
+            conn.close()
+        self._slots.release()
+
+    def _send(self, url, data, method, headers):
+        parsed = urlparse(url)
+        path = parsed.path or "/"
+        if parsed.query:
+            path += "?" + parsed.query
+
+        # let the cookie jar decide what goes into the Cookie header
+        cookie_request = Request(url, data, headers=headers, method=method)
+        self.cookies.add_cookie_header(cookie_request)
+        all_headers = dict(cookie_request.header_items())
+        if data is not None and "Content-Length" not in all_headers:
+            if not hasattr(data, "read"):
+                all_headers["Content-Length"] = str(len(data))
+            elif hasattr(data, "seek"):
+                # send seekable files with a length, not chunked
+                start = data.tell()
+                all_headers["Content-Length"] = str(data.seek(0, 2) - start)
+                data.seek(start)
+        start = data.tell() if hasattr(data, "seek") else None
+
+        conn, reused = self._checkout()
+        try:
+            try:
+                conn.request(method, path, body=data, headers=all_headers)
+                response = conn.getresponse()
+            except _stale_connection_errors:
+                if not reused or (hasattr(data, "read") and start is None):
+                    raise
+                if start is not None:
+                    data.seek(start)
+                # the server dropped an idle connection, try once more on a fresh one
+                conn.close()
+                with self._lock:
+                    self.connections_opened += 1
+                conn = self.connection_class(self.host, self.port, timeout=self.timeout)
+                conn.request(method, path, body=data, headers=all_headers)
+                response = conn.getresponse()
+            body = response.read()
+        except:
+            self._checkin(conn, False)
+            raise
+        self._checkin(conn, not response.will_close)
+
+        self.cookies.extract_cookies(response, cookie_request)
+        with self._lock:
+            self.requests += 1
+        return HTTPResponse(url, response.status, response.reason, response.msg, body)
+
+    def request(self, url, data=None, method=None, headers=None):
+        """Send a request and return the HTTPResponse, following redirects.
+
+        Like urlopen, a request with data is a POST by default and error
+        statuses raise HTTPError.
+        """
+        if method is None:
+            method = "GET" if data is None else "POST"
+        headers = headers or {}
+        for _ in range(MAX_REDIRECTS):
+            if get_origin(url) == self.origin:
+                response = self._send(url, data, method, headers)
+            else:
+                response = get_client(url, self.cookies)._send(url, data, method, headers)
+            location = response.headers.get("Location")
+            if response.status not in (301, 302, 303, 307) or not location:
+                break
+            url = urljoin(url, location)
+            if response.status != 307:
+                data, method = None, "GET"
+
+        if response.status >= 400:
+            raise HTTPError(url, response.status, response.reason, response.headers,
+                            io.BytesIO(response.body))
+        return response
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "connections_opened": self.connections_opened,
+            "connections_reused": self.connections_reused,
+            "idle_connections": len(self._idle),
+        }
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(url, cookies):
+    """Return the shared client for the server url points to"""
+    origin = get_origin(url)
+    with _clients_lock:
+        client = _clients.get(origin)
+        if (client is None) or (client.cookies is not cookies):
+            if client is not None:
+                client.close()
+            client = HTTPClient(origin, cookies)
+            _clients[origin] = client
+        return client
+
+
+def close_clients():
+    with _clients_lock:
+        clients = list(_clients.values())
+        _clients.clear()
+    for client in clients:
+        client.close()
@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013, Maxim Grechkin
+# This file is licensed under GNU General Public License version 3
+# See COPYING for details.
+import socket
+import select
+import struct
+import threading
+import _thread
+import queue
+import traceback
+
+from .external.websocket import websocket3 as websocket
+from .external.websocket.websocket3 import ABNF
+
+READ_SIZE = 65536
+# the least room left in the read buffer before it is compacted
+MIN_READ = 4096
+# the read buffer grown for a large frame is kept up to this size
+KEEP_SIZE = 8 * 1024 * 1024
+
+
+class FrameParser(object):
+    """Incremental parser for the frames of a server to client websocket stream.
+
+    Bytes are received straight into a preallocated buffer (recv_from) and
+    frames are parsed where they are. The payloads handed out are
+    memoryviews of the buffer, valid until the next read.
+    """
+    def __init__(self, size=READ_SIZE):
+        self.size = size
+        self.buffer = bytearray(size)
+        # bytes received but not parsed yet are buffer[start:end]
+        self.start = 0
+        self.end = 0
+        # size of the frame at start, once its header is in
+        self.needed = 0
+        self.fragments = []
+        self.fragment_opcode = None
+
+    def _make_room(self):
+        pending = self.end - self.start
+        capacity = max(self.size, self.needed)
+        if (capacity > len(self.buffer)) or ((len(self.buffer) > KEEP_SIZE) and (capacity < len(self.buffer))
+                                             and (pending <= self.size // 2)):
+            # a new buffer for a frame that does not fit, or back to the
+            # usual size after a very large one. Views handed out keep the
+            # old buffer alive
+            buffer = bytearray(max(capacity, pending + MIN_READ))
+            buffer[:pending] = memoryview(self.buffer)[self.start:self.end]
+            self.buffer = buffer
+            self.start, self.end = 0, pending
+        elif len(self.buffer) - self.end < MIN_READ:
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+            self.start, self.end = 0, pending
+
+    def recv_from(self, sock):
+        """Receive what sock has (up to the room in the buffer), return the
+        number of bytes"""
+        self._make_room()
+        n = sock.recv_into(memoryview(self.buffer)[self.end:])
+        self.end += n
+        return n
+
+    def feed(self, data):
+        """Add received bytes and return a list of complete (opcode, payload) messages"""
+        self.needed = max(self.needed, self.end - self.start + len(data))
+        self._make_room()
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+        return self.messages()
+
+    def messages(self):
+        """Return a list of the complete (opcode, payload) messages received"""
+        messages = []
+        view = memoryview(self.buffer)
+        while True:
+            frame = self._next_frame(view)
+            if frame is None:
+                break
+            fin, opcode, payload = frame
+            if opcode == 0:  # continuation frame
+                self.fragments.append(bytes(payload))
+                if fin:
+                    messages.append((self.fragment_opcode, b"".join(self.fragments)))
+                    self.fragments = []
+            elif fin or (opcode not in (ABNF.OPCODE_TEXT, ABNF.OPCODE_BINARY)):
+                messages.append((opcode, payload))
+            else:
+                self.fragment_opcode = opcode
+                self.fragments = [bytes(payload)]
+        if self.start == self.end:
+            self.start = self.end = 0
+        return messages
+
+    def _next_frame(self, buf):
+        pos = self.start
+        available = self.end - pos
+        self.needed = 0
+        if available < 2:
+            return None
+        fin = buf[pos] >> 7 & 1
+        opcode = buf[pos] & 0xf
+        mask = buf[pos+1] >> 7 & 1
+        length = buf[pos+1] & 0x7f
+        header = 2
+        if length == 0x7e:
+            if available < 4:
+                return None
+            length = struct.unpack_from("!H", buf, pos + 2)[0]
+            header = 4
+        elif length == 0x7f:
+            if available < 10:
+                return None
+            length = struct.unpack_from("!Q", buf, pos + 2)[0]
+            header = 10
+        mask_key = None
+        if mask:
+            if available < header + 4:
+                return None
+            mask_key = bytes(buf[pos+header:pos+header+4])
+            header += 4
+        if available < header + length:
+            self.needed = header + length
+            return None
+        payload = buf[pos+header:pos+header+length]
+        self.start = pos + header + length
+        if mask_key:
+            payload = memoryview(ABNF.mask(mask_key, payload))
+        return fin, opcode, payload
+
+
+class Channel(object):
+    """A websocket connection served by an IOLoop.
+
+    Takes the same callbacks as websocket.WebSocketApp, but instead of
+    running its own receive loop it is handed to the shared IOLoop once
+    the handshake is done.
+    """
+    def __init__(self, url, header=[], on_open=None, on_message=None,
+                 on_error=None, on_close=None):
+        self.url = url
+        self.header = header
+        self.on_open = on_open
+        self.on_message = on_message
+        self.on_error = on_error
+        self.on_close = on_close
+        self.sock = None
+        self.loop = None
+        self.closed = False
+        self.parser = FrameParser()
+        self._send_lock = threading.Lock()
+
+    def fileno(self):
+        return self.sock.sock.fileno()
+
+    def send(self, data, opcode=ABNF.OPCODE_TEXT):
+        if self.sock is None or not self.sock.connected:
+            raise websocket.WebSocketConnectionClosedException()
+        with self._send_lock:
+            self.sock.send(data, opcode)
+
+    def close(self):
+        self.closed = True
+        if self.loop is not None:
+            self.loop.remove(self)
+
+    def on_readable(self):
+        sock = self.sock.sock
+        if not self.parser.recv_from(sock):
+            raise websocket.WebSocketConnectionClosedException()
+        # ssl sockets may have decrypted data left that select does not report
+        while getattr(sock, "pending", None) and sock.pending():
+            self.parser.recv_from(sock)
+        self.dispatch(self.parser.messages())
+
+    def dispatch(self, messages):
+        for opcode, payload in messages:
+            if opcode == ABNF.OPCODE_TEXT:
+                # decoded straight from the read buffer
+                self._callback(self.on_message, str(payload, "utf-8"))
+            elif opcode == ABNF.OPCODE_BINARY:
+                self._callback(self.on_message, bytes(payload))
+            elif opcode == ABNF.OPCODE_PING:
+                self.send(bytes(payload), ABNF.OPCODE_PONG)
+            elif opcode == ABNF.OPCODE_CLOSE:
+                raise websocket.WebSocketConnectionClosedException()
+
+    def _callback(self, callback, *args):
+        if callback:
+            try:
+                callback(self, *args)
+            except Exception as e:
+                print(e)
+                traceback.print_exc()
+
+
+def wakeup_pair():
+    """A connected pair of loopback sockets (socket.socketpair is missing
+    on Windows before Python 3.5)"""
+    server = socket.socket()
+    try:
+        server.bind(("127.0.0.1", 0))
+        server.listen(1)
+        writer = socket.create_connection(server.getsockname())
+        reader, _ = server.accept()
+    finally:
+        server.close()
+    return reader, writer
+
+
+class IOLoop(object):
+    """Serves the reads of all channels from a single select thread.
+
+    Handshakes run on short lived threads, so a slow server does not hold
+    up the traffic of the others.
+    """
+    def __init__(self):
+        self.readers = {}  # fileno -> channel
+        self._calls = queue.Queue()
+        self._wakeup_r, self._wakeup_w = wakeup_pair()
+        self._wakeup_r.setblocking(False)
+        self.channels = set()
+        self.thread_id = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self.thread_id is None:
+                self.thread_id = _thread.start_new_thread(self.run, ())
+
+    def call_soon(self, func, *args):
+        self._calls.put((func, args))
+        try:
+            self._wakeup_w.send(b"\0")
+        except OSError:
+            pass
+
+    def connect(self, channel):
+        self.start()
+        channel.loop = self
+        _thread.start_new_thread(self._handshake, (channel,))
+
+    def remove(self, channel):
+        self.call_soon(self._drop, channel)
+
+    def _handshake(self, channel):
+        try:
+            sock = websocket.WebSocket()
+            sock.settimeout(websocket.getdefaulttimeout())
+            sock.connect(channel.url, header=channel.header)
+        except Exception as e:
+            channel._callback(channel.on_error, e)
+            channel._callback(channel.on_close)
+            return
+        channel.sock = sock
+        self.call_soon(self._add, channel)
+
+    def _add(self, channel):
+        if channel.closed:
+            channel.sock._closeInternal()
+            return
+        self.readers[channel.fileno()] = channel
+        self.channels.add(channel)
+        channel._callback(channel.on_open)
+        # frames that came in with the end of the handshake
+        leftover = channel.sock.take_buffered()
+        if leftover:
+            try:
+                channel.dispatch(channel.parser.feed(leftover))
+            except Exception as e:
+                self._drop(channel, e)
+
+    def _drop(self, channel, error=None):
+        if channel not in self.channels:
+            return
+        self.channels.discard(channel)
+        for fileno, reader in list(self.readers.items()):
+            if reader is channel:
+                del self.readers[fileno]
+        if error is not None:
+            channel._callback(channel.on_error, error)
+        try:
+            # do not wait for the server's close frame, it would stall the loop
+            if channel.sock.connected:
+                channel.send(struct.pack("!H", websocket.STATUS_NORMAL), ABNF.OPCODE_CLOSE)
+        except Exception:
+            pass
+        channel.sock._closeInternal()
+        channel._callback(channel.on_close)
+
+    def run(self):
+        while True:
+            readable, _, _ = select.select([self._wakeup_r] + list(self.readers), [], [])
+            for fileno in readable:
+                if fileno is self._wakeup_r:
+                    try:
+                        while self._wakeup_r.recv(4096):
+                            pass
+                    except OSError:
+                        pass
+                    continue
+                channel = self.readers.get(fileno)
+                if channel is None:
+                    continue  # dropped while handling another channel
+                try:
+                    channel.on_readable()
+                except Exception as e:
+                    self._drop(channel, e)
+
+            while not self._calls.empty():
+                func, args = self._calls.get()
+                try:
+                    func(*args)
+                except Exception as e:
+                    print(e)
+                    traceback.print_exc()
+
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def get_loop():
+    """Return the IOLoop shared by all kernels"""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = IOLoop()
+        return _loop
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013, Maxim Grechkin
+# This file is licensed under GNU General Public License version 3
+# See COPYING for details.
+import os
+import json
+import hashlib
+import threading
+
+from . import ipy_nbwriter
+from .ipy_blobs import BlobEncoder
+from .ipy_outputs import output_size
+from .ipy_records import new_output
+
+FLUSH_INTERVAL = 1.0
+COMPACT_BYTES = 4 * 1024 * 1024
+OUTPUT_SIZE = 64 * 1024
+
+
+def journal_path(directory, baseurl, notebook_id):
+    name = hashlib.sha1((baseurl + "/" + notebook_id).encode("utf-8")).hexdigest()
+    return os.path.join(directory, name + ".journal")
+
+
+def read_journal(path):
+    """Read a journal file.
+
+    Returns (base, records): base is ("server", content_hash) if the records
+    apply to the copy on the server, or ("snapshot", notebook_json) if they
+    apply to a copy kept in the journal. Returns None if there is no journal.
+    A record cut short by a crash ends the list.
+    """
+    try:
+        with open(path, "rb") as f:
+            text = f.read().decode("utf-8")
+    except (IOError, OSError, UnicodeDecodeError):
+        return None
+    try:
+        header_end = text.index("\n") + 1
+        header = json.loads(text[:header_end])
+        if header[1] == "snapshot":
+            # the snapshot is written by ipy_nbwriter and spans many lines
+            _, end = json.JSONDecoder().raw_decode(text, header_end)
+            base = ("snapshot", text[header_end:end])
+            header_end = end
+        else:
+            base = ("server", header[2])
+    except (ValueError, IndexError):
+        return None
+
+    records = []
+    for line in text[header_end:].split("\n"):
+        if not line:
+            continue
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            break
+    return base, records
+
+
+def journal_output(output, max_size=OUTPUT_SIZE):
+    """The output node as it goes into the journal: one bigger than
+    max_size (an image, most likely) is replaced by a note"""
+    size = output_size(output)
+    if size <= max_size:
+        return output
+    return new_output("stream", "[... %d bytes of output were not kept in the journal ...]\n" % size,
+                      stream="stdout")
+
+
+class EditJournal(object):
+    """Append-only log of the changes made to an open notebook.
+
+    Records are buffered and written (and fsynced) at most every
+    flush_interval seconds. The journal is started afresh when the notebook
+    is saved, and when its records grow past compact_bytes the notebook
+    rewrites it as a snapshot (see Notebook.compact_journal).
+    """
+    def __init__(self, path, flush_interval=FLUSH_INTERVAL, compact_bytes=COMPACT_BYTES):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.compact_bytes = compact_bytes
+        self.file = None
+        self.closed = False
+        self.size = 0
+        self.base_size = 0
+        self.records = 0
+        self.flushes = 0
+        self.compactions = 0
+        self._buffer = []
+        self._after = None  # records that follow the snapshot of a compaction
+        self._timer = None
+        self._lock = threading.RLock()
+
+    def append(self, record):
+        data = json.dumps(record, cls=BlobEncoder)
+        with self._lock:
+            self._buffer.append(data)
+            if self._after is not None:
+                self._after.append(data)
+            self.records += 1
+            if self._timer is None:
+                self._timer = threading.Timer(self.flush_interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            self._timer = None
+            if not self._buffer or self.file is None:
+                return
+            data = ("\n".join(self._buffer) + "\n").encode("utf-8")
+            self._buffer = []
+            self.file.write(data)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.size += len(data)
+            self.flushes += 1
+
+    def wants_compaction(self):
+        return (self._after is None) and (self.size - self.base_size > self.compact_bytes)
+
+    def _write_base(self, path, header, snapshot=None):
+        """Write the header (and the notebook tree snapshot) to a new file,
+        return its size"""
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(path, "wb") as f:
+            f.write((json.dumps(header) + "\n").encode("utf-8"))
+            if snapshot is not None:
+                ipy_nbwriter.write_json(snapshot, f)
+                f.write(b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+            return f.tell()
+
+    def _replace(self, path, size, base_size):
+        if self.file is not None:
+            self.file.close()
+        os.replace(path, self.path)
+        self.file = open(self.path, "ab")
+        self.size = size
+        self.base_size = base_size
+
+    def reset(self, content_hash):
+        """Start over from the copy on the server, which has content_hash"""
+        with self._lock:
+            self._buffer = []
+            self._after = None
+            tmp_path = self.path + ".tmp"
+            size = self._write_base(tmp_path, ["base", "server", content_hash])
+            self._replace(tmp_path, size, size)
+
+    def begin_compaction(self):
+        """The caller took a snapshot of the notebook, the records appended
+        from now on are the ones that follow it"""
+        with self._lock:
+            self._after = []
+
+    def finish_compaction(self, snapshot):
+        """Replace the journal by the snapshot and the records that followed it.
+
+        The snapshot is written without holding the lock, so appending goes
+        on meanwhile; a reset or close since begin_compaction drops it.
+        """
+        tmp_path = self.path + ".compact"
+        try:
+            base_size = self._write_base(tmp_path, ["base", "snapshot"], snapshot)
+        except (IOError, OSError) as e:
+            print("Cannot compact the journal: %s" % e)
+            with self._lock:
+                self._after = None
+            return
+        with self._lock:
+            if (self._after is None) or self.closed:
+                os.remove(tmp_path)
+                return
+            size = base_size
+            if self._after:
+                data = ("\n".join(self._after) + "\n").encode("utf-8")
+                with open(tmp_path, "ab") as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                size += len(data)
+            self._after = None
+            self._buffer = []
+            self._replace(tmp_path, size, base_size)
+            self.compactions += 1
+
+    def close(self, remove=False):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+            self.flush()
+            self.closed = True
+            self._after = None
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            if remove:
+                try:
+                    os.remove(self.path)
+                except OSError:
+                    pass
+
+    def stats(self):
+        return {
+            "journal_records": self.records,
+            "journal_flushes": self.flushes,
+            "journal_compactions": self.compactions,
+            "journal_file_bytes": self.size,
+        }
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013, Maxim Grechkin
+# This file is licensed under GNU General Public License version 3
+# See COPYING for details.
+import threading
+import time
+from collections import deque, OrderedDict
+
+LATENCY_SAMPLES = 1000
+MAX_TRACES = 256
+
+# what is measured: (name, from event, to event). The events of an
+# execute_request are "sent", "busy" and "idle" (its status messages),
+# "output" (the first output received), "reply" (execute_reply) and
+# "rendered" (the first output shown in the view)
+METRICS = (
+    ("queue", "sent", "busy"),
+    ("execution", "busy", "reply"),
+    ("first_output", "sent", "output"),
+    ("render", "output", "rendered"),
+    ("round_trip", "sent", "idle"),
+)
+
+
+def format_seconds(seconds):
+    if seconds < 1:
+        return "%dms" % round(seconds * 1000)
+    return "%.2fs" % seconds
+
+
+class Histogram(object):
+    """The last size samples of a metric"""
+    def __init__(self, size=LATENCY_SAMPLES):
+        self.samples = deque(maxlen=size)
+        self.count = 0
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+
+    def percentiles(self, *ps):
+        values = sorted(self.samples)
+        if not values:
+            return [None] * len(ps)
+        return [values[min(int(p / 100.0 * len(values)), len(values) - 1)] for p in ps]
+
+    def buckets(self):
+        """[(upper bound in seconds, count)], the bounds doubling from 1ms"""
+        counts = OrderedDict()
+        bound = 0.001
+        for value in sorted(self.samples):
+            while value > bound:
+                bound *= 2
+            counts[bound] = counts.get(bound, 0) + 1
+        return list(counts.items())
+
+
+class LatencyTracker(object):
+    """Timestamps the lifecycle of execute_requests by msg_id and keeps
+    rolling histograms of the time between them (see METRICS).
+
+    Events come from the thread receiving messages as well as from the
+    main thread, only the first event of a kind counts for a request."""
+    def __init__(self, size=LATENCY_SAMPLES, max_traces=MAX_TRACES):
+        self.histograms = OrderedDict((name, Histogram(size)) for name, _, _ in METRICS)
+        self.traces = OrderedDict()
+        self.max_traces = max_traces
+        self._lock = threading.Lock()
+
+    def start(self, msg_id):
+        with self._lock:
+            self.traces[msg_id] = {"sent": time.time()}
+            while len(self.traces) > self.max_traces:
+                self.traces.popitem(last=False)
+
+    def event(self, msg_id, name):
+        if msg_id not in self.traces:
+            return
+        now = time.time()
+        with self._lock:
+            trace = self.traces.get(msg_id)
+            if (trace is None) or (name in trace):
+                return
+            trace[name] = now
+            for metric, begin, end in METRICS:
+                if (name in (begin, end)) and (begin in trace) and (end in trace):
+                    self.histograms[metric].add(max(trace[end] - trace[begin], 0.0))
+
+    def summary(self):
+        """Short text for the status bar, empty before the first run"""
+        p50, p95 = self.histograms["round_trip"].percentiles(50, 95)
+        if p50 is None:
+            return ""
+        text = "run p50 %s p95 %s" % (format_seconds(p50), format_seconds(p95))
+        render = self.histograms["render"].percentiles(95)[0]
+        if render is not None:
+            text += ", render p95 %s" % format_seconds(render)
+        return text
+
+    def dump(self):
+        lines = []
+        for metric, begin, end in METRICS:
+            histogram = self.histograms[metric]
+            with self._lock:
+                p50, p95, p99 = histogram.percentiles(50, 95, 99)
+                buckets = histogram.buckets()
+            lines.append("%s (%s to %s): %d samples" % (metric, begin, end, histogram.count))
+            if p50 is None:
+                lines.append("")
+                continue
+            lines.append("  p50 %s  p95 %s  p99 %s" % (format_seconds(p50), format_seconds(p95), format_seconds(p99)))
+            most = max(count for _, count in buckets)
+            for bound, count in buckets:
+                lines.append("  <= %7s %6d %s" % (format_seconds(bound), count, "#" * max(1, 40 * count // most)))
+            lines.append("")
+        return "\n".join(lines)
+
+    def stats(self):
+        result = {}
+        for metric, histogram in self.histograms.items():
+            with self._lock:
+                p50, p95 = histogram.percentiles(50, 95)
+            if p50 is not None:
+                result["latency_%s_p50" % metric] = format_seconds(p50)
+                result["latency_%s_p95" % metric] = format_seconds(p95)
+        return result
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013, Maxim Grechkin
+# This file is licensed under GNU General Public License version 3
+# See COPYING for details.
+import json
+
+from .external.nbformat3.nbbase import from_dict
+from .external.nbformat3.rwbase import _join_lines, _multiline_outputs
+from .ipy_records import CellRecord, OutputRecord
+from . import ipy_blobs
+
+
+def reads(s):
+    """Parse notebook JSON like nbformat.reads_json, except for the cells.
+
+    The cells of the first worksheet (the one that is shown) are left as the
+    plain dicts json.loads made; materialize_cell converts one when it is
+    first needed.
+    """
+    d = json.loads(s)
+    worksheets = d.pop("worksheets", [])
+    nb = from_dict(d)
+    nb.worksheets = []
+    for ws in worksheets:
+        cells = ws.pop("cells", None)
+        node = from_dict(ws)
+        if cells is not None:
+            if nb.worksheets:
+                cells = [materialize_cell(cell) for cell in cells]
+            node.cells = cells
+        nb.worksheets.append(node)
+    return nb
+
+
+def is_materialized(cell):
+    return isinstance(cell, CellRecord)
+
+
+def materialize_cell(d):
+    """Convert a cell dict from reads into a CellRecord.
+
+    Does what rejoin_lines, restore_bytes and from_dict do in a single walk,
+    with the images going straight into the blob store.
+    """
+    cell = CellRecord()
+    if d.get("cell_type") == "code":
+        for key, value in d.items():
+            if key == "outputs":
+                value = [materialize_output(output) for output in value]
+            elif (key == "input") and isinstance(value, list):
+                value = _join_lines(value)
+            else:
+                value = from_dict(value)
+            cell[key] = value
+    else:
+        for key, value in d.items():
+            if (key in ("source", "rendered")) and isinstance(value, list):
+                value = _join_lines(value)
+            else:
+                value = from_dict(value)
+            cell[key] = value
+    return cell
+
+
+def materialize_output(d):
+    blobs = ipy_blobs.get_blob_store()
+    output = OutputRecord()
+    for key, value in d.items():
+        if (key in _multiline_outputs) and isinstance(value, list):
+            value = _join_lines(value)
+        if (key in ipy_blobs.blob_keys) and isinstance(value, str):
+            value = blobs.put(value)
+        else:
+            value = from_dict(value)
+        output[key] = value
+    return output
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013, Maxim Grechkin
+# This file is licensed under GNU General Public License version 3
+# See COPYING for details.
+from json.encoder import encode_basestring_ascii
+
+from .ipy_blobs import BlobRef, BlobEncoder
+from .ipy_records import Record
+from .external.nbformat3.rwbase import _multiline_outputs, _join_lines
+
+CHUNK_SIZE = 64 * 1024
+
+_encoder = BlobEncoder()
+
+
+def _split(value):
+    if isinstance(value, BlobRef):
+        value = value.load()
+    elif isinstance(value, list):
+        # lines of a cell that ipy_nbreader has not converted yet
+        value = _join_lines(value)
+    if isinstance(value, str):
+        return value.splitlines(True)
+    return value
+
+
+def _child_kind(kind, node, key):
+    """What the value under key is, for the nodes split_lines looks into"""
+    if kind == "notebook":
+        return "worksheet" if key == "worksheets" else None
+    if kind == "worksheet":
+        return "cell" if key == "cells" else None
+    if kind == "cell":
+        if node.get("cell_type") == "code":
+            if key == "input":
+                return "lines"
+            return "output" if key == "outputs" else None
+        return "lines" if key in ("source", "rendered") else None
+    if kind == "output":
+        return "lines" if key in _multiline_outputs else None
+    return None
+
+
+def _iter_value(value, indent, kind=None):
+    if isinstance(value, str):
+        yield encode_basestring_ascii(value)
+    elif isinstance(value, dict):
+        yield from _iter_dict(value, indent, kind)
+    elif isinstance(value, Record):
+        yield from _iter_dict(value.to_dict(), indent, kind)
+    elif isinstance(value, (list, tuple)) or hasattr(value, "__next__"):
+        yield from _iter_list(value, indent, kind)
+    else:
+        yield _encoder.encode(value)
+
+
+def _iter_dict(node, indent, kind):
+    if not node:
+        yield "{}"
+        return
+    inner = indent + " "
+    separator = "{\n" + inner
+    for key, value in sorted(node.items()):
+        child = _child_kind(kind, node, key)
+        if child == "lines":
+            value, child = _split(value), None
+        yield separator + encode_basestring_ascii(key) + ": "
+        yield from _iter_value(value, inner, child)
+        separator = ",\n" + inner
+    yield "\n" + indent + "}"
+
+
+def _iter_list(items, indent, kind):
+    inner = indent + " "
+    separator = "[\n" + inner
+    for item in items:
+        yield separator
+        yield from _iter_value(item, inner, kind)
+        separator = ",\n" + inner
+    if separator[0] == "[":
+        yield "[]"
+    else:
+        yield "\n" + indent + "]"
+
+
+def iter_json(nb):
+    """Serialize a notebook tree piece by piece.
+
+    The result is the same as nbformat.writes_json(nb), but multiline text is
+    split as it is written instead of on a deep copy of the notebook, images
+    are read from the blob store one at a time and lists of outputs may be
+    any iterable.
+    """
+    return _iter_value(nb, "", "notebook")
+
+
+def iter_chunks(nb, chunk_size=CHUNK_SIZE, encoding="utf-8"):
+    """Serialize a notebook tree into encoded chunks of about chunk_size bytes"""
+    pieces = []
+    size = 0
+    for piece in iter_json(nb):
+        pieces.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield "".join(pieces).encode(encoding)
+            pieces = []
+            size = 0
+    if pieces:
+        yield "".join(pieces).encode(encoding)
+
+
+def write_json(nb, f, encoding="utf-8", digest=None):
+    """Write a notebook tree to a binary file, return the number of bytes written.
+    If digest is given (a hashlib object), it is updated with the written data."""
+    written = 0
+    for chunk in iter_chunks(nb, encoding=encoding):
+        f.write(chunk)
+        if digest is not None:
+            digest.update(chunk)
+        written += len(chunk)
+    return written
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013, Maxim Grechkin
+# This file is licensed under GNU General Public License version 3
+# See COPYING for details.
+import re
+import json
+import mmap
+import bisect
+import itertools
+import tempfile
+import threading
+
+from .ipy_blobs import BlobRef, BlobEncoder, blob_keys
+from .ipy_records import new_output
+from .ipy_nbreader import materialize_output
+
+OUTPUT_HEAD_SIZE = 256 * 1024
+OUTPUT_TAIL_SIZE = 256 * 1024
+PAGE_SIZE = 64 * 1024
+
+SPILLED_OUTPUT_TEXT = "\n[... more output was moved to disk, page through the cell output to see it ...]\n"
+
+_size_keys = ["text", "html", "svg", "png", "jpeg", "latex", "json", "javascript"]
+
+_line_controls_re = re.compile("([\r\b])")
+
+
+def compact_line(line, keep_cursor=True):
+    """Apply carriage returns and backspaces in a line like a terminal would.
+
+    If the cursor does not end up at the end of the line, it is encoded as
+    a trailing "\r" followed by the text before it, so that the result
+    can be compacted again together with the text that follows.
+    """
+    chars = []
+    pos = 0
+    for part in _line_controls_re.split(line):
+        if part == "\r":
+            pos = 0
+        elif part == "\b":
+            pos = max(pos - 1, 0)
+        elif part:
+            chars[pos:pos+len(part)] = part
+            pos += len(part)
+    result = "".join(chars)
+    if keep_cursor and pos < len(chars):
+        result += "\r" + result[:pos]
+    return result
+
+
+def compact_stream_text(text):
+    if ("\r" not in text) and ("\b" not in text):
+        return text
+    lines = text.split("\n")
+    for i, line in enumerate(lines):
+        if ("\r" in line) or ("\b" in line):
+            lines[i] = compact_line(line, keep_cursor=(i == len(lines) - 1))
+    return "\n".join(lines)
+
+
+def render_output(output):
+    """Text shown in the buffer for a single output node"""
+    if "text" in output:
+        text = output.text
+        if "\r" in text:
+            # only the unfinished last line of a stream can still have one
+            head, sep, tail = text.rpartition("\n")
+            text = head + sep + compact_line(tail, keep_cursor=False)
+        return text
+    elif "traceback" in output:
+        data = "\n".join(output.traceback)
+        data = re.sub("\x1b[^m]*m", "", data)  # remove escape characters
+        if not data.endswith("\n"):
+            data += "\n"
+        return data
+    return ""
+
+
+def output_size(output):
+    size = sum(len(output[key]) for key in _size_keys if key in output)
+    if "traceback" in output:
+        size += sum(len(frame) for frame in output.traceback)
+    return size
+
+
+class SpillEncoder(BlobEncoder):
+    """Writes BlobRefs by their key, the store keeps the payload"""
+    def default(self, obj):
+        if isinstance(obj, BlobRef):
+            return {"blob": obj.key}
+        return BlobEncoder.default(self, obj)
+
+
+class OutputStore(object):
+    """Keeps the output of a cell within a memory budget.
+
+    The first head_size bytes of output nodes stay in memory, and so do
+    the last tail_size bytes. Nodes that fall out of the tail are written
+    to a temporary file, one JSON record per node, and read back through
+    mmap when the output is paged or the full notebook is saved.
+    The node being appended to always stays in memory. Images in spilled
+    nodes are written by their blob key, the store keeps their BlobRefs.
+    """
+    def __init__(self, head_size=OUTPUT_HEAD_SIZE, tail_size=OUTPUT_TAIL_SIZE):
+        self.head_size = head_size
+        self.tail_size = tail_size
+        self.sizes = []
+        self.head_count = None
+        self.tail_bytes = 0  # size of the nodes after the head (all of them until it is known)
+        self.file = None
+        self.records = []  # (offset, length) of every spilled node
+        self.rendered_ends = []  # cumulative rendered length of spilled nodes
+        self.spilled_bytes = 0
+        self.blobs = {}  # key -> BlobRef of the images in spilled nodes
+        self._mmap = None
+        self._lock = threading.RLock()
+
+    @property
+    def spilled_count(self):
+        return len(self.records)
+
+    def added(self, outputs):
+        """Outputs were appended to or the last one grew; spill what does not fit.
+
+        The spilled nodes are removed from outputs, right after the head.
+        Returns how many were spilled.
+        """
+        sizes = self.sizes
+        if sizes:
+            size = output_size(outputs[len(sizes) - 1])
+            self.tail_bytes += size - sizes[-1]
+            sizes[-1] = size
+        while len(sizes) < len(outputs):
+            size = output_size(outputs[len(sizes)])
+            self.tail_bytes += size
+            sizes.append(size)
+
+        if self.head_count is None:
+            if self.tail_bytes <= self.head_size + self.tail_size:
+                return 0
+            total = 0
+            self.head_count = 0
+            for size in sizes:
+                if total + size > self.head_size:
+                    break
+                total += size
+                self.head_count += 1
+            self.tail_bytes -= total
+
+        first = end = self.head_count
+        last = len(outputs) - 1
+        with self._lock:
+            # a node is either spilled or in outputs for anyone holding the lock
+            while (self.tail_bytes > self.tail_size) and (end < last):
+                self.spill(outputs[end])
+                self.tail_bytes -= sizes[end]
+                end += 1
+            del outputs[first:end]
+        del sizes[first:end]
+        return end - first
+
+    def spill(self, output):
+        for key in blob_keys:
+            value = output.get(key)
+            if isinstance(value, BlobRef):
+                self.blobs[value.key] = value
+        data = json.dumps(output, cls=SpillEncoder).encode("utf-8")
+        with self._lock:
+            if self.file is None:
+                self.file = tempfile.TemporaryFile(prefix="ipynb_output_")
+            self.file.seek(0, 2)
+            self.records.append((self.file.tell(), len(data)))
+            self.file.write(data)
+            rendered = len(render_output(output))
+            self.rendered_ends.append((self.rendered_ends[-1] if self.rendered_ends else 0) + rendered)
+            self.spilled_bytes += len(data)
+
+    def load(self, index):
+        offset, length = self.records[index]
+        with self._lock:
+            if (self._mmap is None) or (len(self._mmap) < offset + length):
+                self.file.flush()
+                if self._mmap is not None:
+                    self._mmap.close()
+                self._mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            data = self._mmap[offset:offset+length]
+        return self.decode(data, self.blobs)
+
+    def decode(self, data, blobs):
+        output = json.loads(data.decode("utf-8"))
+        for key in blob_keys:
+            if isinstance(output.get(key), dict):
+                output[key] = blobs[output[key]["blob"]]
+        return materialize_output(output)
+
+    def spilled_outputs(self):
+        """Iterate over the nodes spilled so far.
+
+        Nodes spilled later are left out, and the nodes keep coming if the
+        store is closed in the meantime, so that a save on another thread
+        reads what was there when it started.
+        """
+        with self._lock:
+            records = list(self.records)
+            f = self.file
+        return self._read_records(f, records, self.blobs)
+
+    def _read_records(self, f, records, blobs):
+        for offset, length in records:
+            with self._lock:
+                f.seek(offset)
+                data = f.read(length)
+            yield self.decode(data, blobs)
+
+    def full_outputs(self, node):
+        """The outputs of the cell node, with the spilled ones put back in"""
+        with self._lock:
+            outputs = node.outputs
+            if not self.records:
+                return list(outputs)
+            first = self.head_count
+            return outputs[:first] + list(self.spilled_outputs()) + outputs[first:]
+
+    def iter_full_outputs(self, node):
+        """Like full_outputs, but spilled nodes are read as they are iterated over"""
+        with self._lock:
+            outputs = node.outputs
+            if not self.records:
+                return list(outputs)
+            first = self.head_count
+            return itertools.chain(outputs[:first], self.spilled_outputs(), outputs[first:])
+
+    def truncated_outputs(self, node):
+        with self._lock:
+            outputs = node.outputs
+            if not self.records:
+                return list(outputs)
+            first = self.head_count
+            marker = new_output("stream", "\n[... %d bytes of output were not saved ...]\n" % self.spilled_bytes,
+                                stream="stdout")
+            return outputs[:first] + [marker] + outputs[first:]
+
+    def clear(self, node):
+        """Drop the outputs of the cell node, the ones in memory and the
+        spilled ones at the same time"""
+        with self._lock:
+            node.outputs = []
+            self.close()
+
+    def read_page(self, outputs, page, page_size=PAGE_SIZE):
+        """Return the given page of the full rendered output of the cell.
+
+        Only the spilled nodes that overlap with the page are read from disk.
+        """
+        start = page * page_size
+        end = start + page_size
+        first = self.head_count if self.records else len(outputs)
+        result = []
+        pos = 0
+
+        def take(text, pos):
+            if (pos + len(text) > start) and (pos < end):
+                result.append(text[max(start - pos, 0):end - pos])
+            return pos + len(text)
+
+        for output in outputs[:first]:
+            pos = take(render_output(output), pos)
+        if self.records:
+            head_length = pos
+            # skip the spilled nodes that end before the page starts
+            i = bisect.bisect_right(self.rendered_ends, start - head_length)
+            if i > 0:
+                pos += self.rendered_ends[i - 1]
+            while (i < len(self.records)) and (pos < end):
+                pos = take(render_output(self.load(i)), pos)
+                i += 1
+            pos = head_length + self.rendered_ends[-1]
+        for output in outputs[first:]:
+            if pos >= end:
+                break
+            pos = take(render_output(output), pos)
+        return "".join(result)
+
+    def page_count(self, outputs, page_size=PAGE_SIZE):
+        total = sum(len(render_output(output)) for output in outputs)
+        if self.rendered_ends:
+            total += self.rendered_ends[-1]
+        return max((total + page_size - 1) // page_size, 1)
+
+    def close(self):
+        with self._lock:
+            if self._mmap is not None:
+                self._mmap.close()
+                self._mmap = None
+            # not closed here, a save may still be reading it; the file is
+            # closed when the last reference to it goes
+            self.file = None
+            self.records = []
+            self.rendered_ends = []
+            self.spilled_bytes = 0
+            self.blobs = {}
+        self.sizes = []
+        self.head_count = None
+        self.tail_bytes = 0
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013, Maxim Grechkin
+# This file is licensed under GNU General Public License version 3
+# See COPYING for details.
+from bisect import bisect_right
+
+# the marks kept for a cell, relative to the start of its inb_cells region:
+# [cell end, input start, input end, output start, output end]
+_CELL_END, _INPUT, _OUTPUT = 0, 1, 3
+_slots = {"inb_cells": None, "inb_input": _INPUT, "inb_output": _OUTPUT}
+_starts_of_regions = (_INPUT, _OUTPUT)
+
+
+class PositionIndex(object):
+    """Sorted offsets of the cell regions of a notebook view.
+
+    The start of every cell is kept in a sorted list searched with bisect,
+    the rest of a cell's regions as offsets from its start, so an edit in a
+    cell only changes that cell's offsets and the starts after it. Typing in
+    a cell only adds to a pending shift of the following starts, which is
+    settled when an edit happens somewhere else.
+
+    The plugin reports its own edits (edit) or drops the index when it
+    rearranges regions (invalidate). Edits made by the user are caught up
+    with on the next lookup: the change in buffer size is put down to the
+    input of the active cell (the one the caret was in), and if the buffer
+    does not look as expected after that the index is rebuilt from the
+    regions of the view. An edit that leaves the size as it was (a multi
+    cursor replace, swapping lines) is noticed by the change count of the
+    view, and it rebuilds the index.
+    """
+    def __init__(self, view):
+        self.view = view
+        self.starts = []
+        self.marks = []
+        self.size = 0
+        self.change_count = None
+        self.valid = False
+        self.active = -1
+        self.pending_index = -1
+        self.pending_delta = 0
+        self.rebuilds = 0
+        self.catch_ups = 0
+
+    def __len__(self):
+        self.sync()
+        return len(self.starts)
+
+    def reset(self, cells, inputs, outputs, size):
+        """Index the given regions (sorted lists, as from view.get_regions)"""
+        self.starts = []
+        self.marks = []
+        self.pending_index = -1
+        self.pending_delta = 0
+        j = k = 0
+        for cell in cells:
+            start = cell.a
+            marks = [cell.b - start, None, None, None, None]
+            # the regions inside a cell start after its first character
+            while (j < len(inputs)) and (inputs[j].a <= start):
+                j += 1
+            if (j < len(inputs)) and (inputs[j].b <= cell.b):
+                marks[_INPUT] = inputs[j].a - start
+                marks[_INPUT + 1] = inputs[j].b - start
+                j += 1
+            while (k < len(outputs)) and (outputs[k].a <= start):
+                k += 1
+            if (k < len(outputs)) and (outputs[k].b <= cell.b):
+                marks[_OUTPUT] = outputs[k].a - start
+                marks[_OUTPUT + 1] = outputs[k].b - start
+                k += 1
+            self.starts.append(start)
+            self.marks.append(marks)
+        self.size = size
+        self.change_count = self.view.change_count()
+        self.valid = True
+
+    def rebuild(self):
+        view = self.view
+        self.reset(view.get_regions("inb_cells"), view.get_regions("inb_input"),
+                   view.get_regions("inb_output"), view.size())
+        self.rebuilds += 1
+
+    def invalidate(self):
+        self.valid = False
+
+    def sync(self):
+        """Catch up with the edits made since the last lookup"""
+        if not self.valid:
+            self.rebuild()
+            return
+        change_count = self.view.change_count()
+        if change_count == self.change_count:
+            return
+        delta = self.view.size() - self.size
+        if delta and self._catch_up(delta):
+            self.change_count = change_count
+        else:
+            self.rebuild()
+
+    def _catch_up(self, delta):
+        i = self.active
+        sel = self.view.sel()
+        if (i < 0) or (i >= len(self.starts)) or (len(sel) != 1):
+            return False
+        marks = self.marks[i]
+        if marks[_INPUT] is None:
+            return False
+        start = self._start(i)
+        input_start = start + marks[_INPUT]
+        self.edit(i, input_start + 1, max(-delta, 0), max(delta, 0))
+        input_end = start + marks[_INPUT + 1]
+        s = sel[0]
+        view = self.view
+        if not ((input_start < s.begin()) and (s.end() < input_end) and
+                (view.substr(input_start) == "\n") and (view.substr(input_end - 1) == "\n") and
+                (view.substr(input_end) == "#") and (view.substr(start + marks[_CELL_END] - 1) == "\n")):
+            return False
+        self.catch_ups += 1
+        return True
+
+    def _start(self, i):
+        if i > self.pending_index >= 0:
+            return self.starts[i] + self.pending_delta
+        return self.starts[i]
+
+    def _settle(self):
+        k, delta = self.pending_index, self.pending_delta
+        if (k >= 0) and delta:
+            starts = self.starts
+            starts[k+1:] = [start + delta for start in starts[k+1:]]
+        self.pending_index = -1
+        self.pending_delta = 0
+
+    def edit(self, i, pos, old_len, new_len):
+        """old_len characters at pos, in cell i, were replaced by new_len characters"""
+        if not self.valid:
+            return
+        delta = new_len - old_len
+        start = self._start(i)
+        pos -= start
+        end = pos + old_len
+        marks = self.marks[i]
+        for m, value in enumerate(marks):
+            if value is None:
+                continue
+            # like Sublime Text: text inserted at the start of a region
+            # pushes it along, text inserted at its end does not extend it
+            is_start = m in _starts_of_regions
+            if (value > end) or (is_start and (value == end)):
+                marks[m] = value + delta
+            elif value > pos:
+                marks[m] = pos + (new_len if is_start else 0)
+        if delta:
+            if self.pending_index != i:
+                self._settle()
+                self.pending_index = i
+            self.pending_delta += delta
+            self.size += delta
+        self.change_count = self.view.change_count()
+
+    def _bisect(self, pos):
+        """Index of the last cell that starts at or before pos, -1 if none"""
+        starts = self.starts
+        k, delta = self.pending_index, self.pending_delta
+        if (k >= 0) and (k + 1 < len(starts)) and (pos >= starts[k+1] + delta):
+            return bisect_right(starts, pos - delta, k + 1) - 1
+        return bisect_right(starts, pos, 0, k + 1 if k >= 0 else len(starts)) - 1
+
+    def find(self, begin, end=None):
+        """Index of the cell whose region holds begin (and end), or -1"""
+        self.sync()
+        if end is None:
+            end = begin
+        i = self._bisect(begin)
+        if (i < 0) or (end > self._start(i) + self.marks[i][_CELL_END]):
+            return -1
+        return i
+
+    def nearest(self, pos):
+        """Index of the cell at pos, or of the one before it"""
+        self.sync()
+        return max(self._bisect(pos), 0)
+
+    def region(self, i, name):
+        """(begin, end) of region name of cell i, None if it has none"""
+        self.sync()
+        if (i < 0) or (i >= len(self.starts)):
+            return None
+        start = self._start(i)
+        marks = self.marks[i]
+        slot = _slots[name]
+        if slot is None:
+            return start, start + marks[_CELL_END]
+        if marks[slot] is None:
+            return None
+        return start + marks[slot], start + marks[slot + 1]
+
+    def find_input(self, begin, end):
+        """Index of the cell whose input (inside the line breaks that
+        delimit it) holds begin to end, or -1"""
+        i = self.find(begin, end)
+        region = self.region(i, "inb_input") if i >= 0 else None
+        if (region is None) or not (region[0] < begin and end < region[1]):
+            return -1
+        return i
+
+    def stats(self):
+        return {
+            "position_rebuilds": self.rebuilds,
+            "position_catch_ups": self.catch_ups,
+        }
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013, Maxim Grechkin
+# This file is licensed under GNU General Public License version 3
+# See COPYING for details.
+from .external.nbformat3.nbbase import NotebookNode, from_dict
+
+_missing = object()
+
+
+class Record(object):
+    """Slotted stand-in for a NotebookNode with a known set of keys.
+
+    The usual keys are attributes (an unset slot is a missing key), any
+    other key goes to the extra dict. Supports the parts of the dict
+    interface the plugin uses: get, [], in, items.
+    """
+    __slots__ = ("extra",)
+    _fields = ()
+
+    def __init__(self, fields=None):
+        self.extra = None
+        if fields is not None:
+            for key, value in fields.items():
+                self[key] = value
+
+    def get(self, key, default=None):
+        if key in self._field_set:
+            return getattr(self, key, default)
+        if self.extra is None:
+            return default
+        return self.extra.get(key, default)
+
+    def __getitem__(self, key):
+        value = self.get(key, _missing)
+        if value is _missing:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self._field_set:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __contains__(self, key):
+        return self.get(key, _missing) is not _missing
+
+    def items(self):
+        for key in self._fields:
+            value = getattr(self, key, _missing)
+            if value is not _missing:
+                yield key, value
+        if self.extra:
+            for item in self.extra.items():
+                yield item
+
+    def keys(self):
+        return [key for key, _ in self.items()]
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def to_node(self):
+        return NotebookNode((key, from_dict(value)) for key, value in self.items())
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.to_dict())
+
+
+class OutputRecord(Record):
+    _fields = ("output_type", "stream", "text", "html", "svg", "png", "jpeg", "latex",
+               "json", "javascript", "prompt_number", "ename", "evalue", "traceback", "metadata")
+    _field_set = frozenset(_fields)
+    __slots__ = _fields
+
+
+class CellRecord(Record):
+    _fields = ("cell_type", "input", "source", "rendered", "level", "language", "collapsed",
+               "prompt_number", "outputs", "metadata")
+    _field_set = frozenset(_fields)
+    __slots__ = _fields
+
+    def to_node(self):
+        node = Record.to_node(self)
+        if "outputs" in self:
+            node.outputs = [output.to_node() if isinstance(output, Record) else output
+                            for output in self.outputs]
+        return node
+
+
+def new_output(output_type, output_text=None, prompt_number=None,
+               ename=None, evalue=None, traceback=None, stream=None):
+    """Like nbformat.new_output, for the outputs the kernel sends"""
+    output = OutputRecord()
+    output.output_type = output_type
+    output.metadata = {}
+    if (output_type != "pyerr") and (output_text is not None):
+        output.text = output_text
+    if (output_type == "pyout") and (prompt_number is not None):
+        output.prompt_number = int(prompt_number)
+    if output_type == "pyerr":
+        if ename is not None:
+            output.ename = ename
+        if evalue is not None:
+            output.evalue = evalue
+        if traceback is not None:
+            output.traceback = list(traceback)
+    if output_type == "stream":
+        output.stream = "stdout" if stream is None else stream
+    return output
+
+
+def new_code_cell(input=""):
+    cell = CellRecord()
+    cell.cell_type = "code"
+    cell.language = "python"
+    cell.input = input
+    cell.outputs = []
+    cell.collapsed = False
+    cell.metadata = NotebookNode()
+    return cell
+
+
+def new_text_cell(cell_type, source=""):
+    cell = CellRecord()
+    cell.cell_type = cell_type
+    cell.source = source
+    cell.metadata = NotebookNode()
+    return cell
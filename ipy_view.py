@@ -4,48 +4,136 @@
 # See COPYING for details.
 from __future__ import print_function
 import sublime
-from . import ipy_connection
+from . import ipy_connection, ipy_outputs, ipy_blobs, ipy_journal, ipy_positions
+import os
 import re
+import time
+import _thread
 
 
 
-def create_kernel(baseurl, notebook_id):
-    return ipy_connection.Kernel(notebook_id, baseurl)
+def get_settings():
+    return sublime.load_settings("SublimeIPythonNotebook.sublime-settings")
+
+
+def create_kernel(baseurl, notebook_id, autostart=True):
+    settings = get_settings()
+    return ipy_connection.Kernel(notebook_id, baseurl,
+                                 journal_size=settings.get("message_journal_size", ipy_connection.JOURNAL_SIZE),
+                                 journal_bytes=settings.get("message_journal_bytes", ipy_connection.JOURNAL_BYTES),
+                                 batch_latency=settings.get("output_batch_latency", ipy_connection.BATCH_LATENCY),
+                                 autostart=autostart)
+
+# the views of the same notebook share its kernel and channels
+sessions = ipy_connection.SessionPool()
+
+def create_journal(baseurl, notebook_id):
+    settings = get_settings()
+    if not settings.get("edit_journal", True):
+        return None
+    directory = os.path.join(sublime.cache_path(), "IPython Notebook", "journals")
+    return ipy_journal.EditJournal(ipy_journal.journal_path(directory, baseurl, notebook_id),
+                                   flush_interval=settings.get("edit_journal_flush_interval", ipy_journal.FLUSH_INTERVAL),
+                                   compact_bytes=settings.get("edit_journal_compact_bytes", ipy_journal.COMPACT_BYTES))
+
+
+def configure_notebook(notebook):
+    settings = get_settings()
+    notebook.output_head_size = settings.get("output_memory_head", ipy_outputs.OUTPUT_HEAD_SIZE)
+    notebook.output_tail_size = settings.get("output_memory_tail", ipy_outputs.OUTPUT_TAIL_SIZE)
+    notebook.save_spilled_outputs = settings.get("save_spilled_output", True)
+    notebook.journal_output_size = settings.get("edit_journal_max_output", ipy_journal.OUTPUT_SIZE)
+    ipy_blobs.get_blob_store().memory_budget = settings.get("image_memory_budget", ipy_blobs.BLOB_MEMORY_BUDGET)
+
 
 output_draw_style = sublime.HIDDEN
 input_draw_style = sublime.HIDDEN
 cell_draw_style = sublime.HIDDEN
 
+VIRTUAL_RENDER_THRESHOLD = 500
+VIRTUAL_RENDER_MARGIN = 30
+VIEWPORT_POLL_INTERVAL = 200
+EVENT_IDLE_DELAY = 50
+EVENT_MAX_DELAY = 250
+UNDO_COMMANDS = ("undo", "soft_undo", "redo", "redo_or_repeat", "soft_redo")
+
+# what collapsed cells show instead of their input and outputs
+_input_placeholder_re = re.compile(r"# \(\d+ lines hidden\)\Z")
+_output_placeholder_re = re.compile(r" \(\d+ outputs hidden\)\Z")
+
+
+class IdleTask(object):
+    """Runs callback once requests stop coming for delay ms, or max_delay ms
+    after the first request that is still waiting, whichever is sooner"""
+    def __init__(self, callback, delay=EVENT_IDLE_DELAY, max_delay=EVENT_MAX_DELAY):
+        self.callback = callback
+        self.delay = delay
+        self.max_delay = max_delay
+        self.first = None
+        self.last = None
+        self.scheduled = False
+        self.requests = 0
+        self.runs = 0
+
+    def request(self):
+        self.requests += 1
+        self.last = time.time()
+        if self.first is None:
+            self.first = self.last
+        if not self.scheduled:
+            self.scheduled = True
+            sublime.set_timeout(self.tick, self.delay)
+
+    def tick(self):
+        self.scheduled = False
+        if self.first is None:
+            return
+        now = time.time()
+        idle = (now - self.last) * 1000
+        waited = (now - self.first) * 1000
+        if (idle >= self.delay) or (waited >= self.max_delay):
+            self.run()
+        else:
+            self.scheduled = True
+            sublime.set_timeout(self.tick, int(min(self.delay - idle, self.max_delay - waited)) + 1)
+
+    def run(self):
+        if self.first is None:
+            return
+        self.first = None
+        self.runs += 1
+        self.callback()
+
 
 class BaseCellView(object):
-    def __init__(self, index, view, cell):
+    def __init__(self, index, view, cell, positions):
         self.index = index
         self.view = view
         self.cell = cell
+        self.positions = positions
         self.cell.cell_view = self
         self.buffer_ready = False
         self.owned_regions = ["inb_input"]
+        # the input in the buffer was edited since it was copied to the cell
+        self.dirty = False
+        # a placeholder is shown instead of the input (the cell has the text)
+        self.input_collapsed = False
+        self.output_collapsed = False
 
     def get_cell_region(self):
-        try:
-            reg = self.view.get_regions("inb_cells")[self.index]
-            return sublime.Region(reg.a+1, reg.b)
-        except IndexError:
+        reg = self.positions.region(self.index, "inb_cells")
+        if reg is None:
             return None
+        return sublime.Region(reg[0]+1, reg[1])
 
     def run(self, kernel, region):
         pass
 
     def get_region(self, regname):
-        cell_reg = self.get_cell_region()
-        if cell_reg is None:
+        reg = self.positions.region(self.index, regname)
+        if reg is None:
             return None
-        all_regs = self.view.get_regions(regname)
-        for reg in all_regs:
-            if cell_reg.contains(reg):
-                res = sublime.Region(reg.a+1, reg.b-1)
-                return res
-        return None
+        return sublime.Region(reg[0]+1, reg[1]-1)
 
     def get_input_region(self):
         return self.get_region("inb_input")
@@ -58,6 +146,7 @@ class BaseCellView(object):
         region = self.get_region(regname)
         self.view.set_read_only(False)
         self.view.replace(edit, region, text)
+        self.positions.edit(self.index, region.begin(), region.size(), len(text))
 
     def select(self, last_line=False):
         input_region = self.get_input_region()
@@ -75,9 +164,11 @@ class BaseCellView(object):
 
     def setup(self, edit):
         self.buffer_ready = True
+        self.positions.invalidate()
 
     def teardown(self, edit):
         cell_reg = self.get_cell_region()
+        self.positions.invalidate()
         for regname in self.owned_regions:
             all_regs = self.view.get_regions(regname)
             all_regs = [reg for reg in all_regs if not cell_reg.contains(reg)]
@@ -88,7 +179,69 @@ class BaseCellView(object):
         if not self.buffer_ready:
             self.setup(edit)
 
+    def layout(self, pos, pieces, regions):
+        """Lay the cell out at pos without touching the buffer, like setup and
+        draw would: the text goes to pieces, the regions to the lists in
+        regions. Returns the position after the cell."""
+        self.buffer_ready = True
+        cell_start = pos
+        pieces.append("\n")
+        pos += 1
+        for text, regname in self.layout_parts():
+            if regname is not None:
+                if text.endswith("\n"):
+                    text = text[:-1]
+                text = "\n" + text + "\n"
+                regions[regname].append(sublime.Region(pos, pos + len(text)))
+            pieces.append(text)
+            pos += len(text)
+        pieces.append("\n")
+        pos += 1
+        regions["inb_cells"].append(sublime.Region(cell_start, pos))
+        return pos
+
+    def layout_parts(self):
+        """(text, region name or None) pieces of the cell"""
+        return []
+
+    @property
+    def collapsed(self):
+        return self.input_collapsed or self.output_collapsed
+
+    def input_placeholder(self):
+        return "# (%d lines hidden)" % (self.cell.source.count("\n") + 1)
+
+    def sync_collapsed(self, inputs):
+        """Set the collapsed flags from what the buffer shows, after an undo
+        or redo of the edits that collapsed or expanded the cell"""
+        region = self.get_input_region()
+        if (not inputs) or (region is None):
+            return
+        shown = self.view.substr(region)
+        self.input_collapsed = bool(_input_placeholder_re.match(shown)) and (shown != self.cell.source)
+
+    def shown_source(self):
+        if self.input_collapsed:
+            return self.input_placeholder()
+        return self.cell.source
+
+    def collapse(self, edit, inputs):
+        """Show placeholders instead of the content, which stays in the cell"""
+        if inputs and not self.input_collapsed:
+            if self.dirty:
+                self.dirty = False
+                self.update_code()
+            self.write_to_region(edit, "inb_input", self.input_placeholder())
+            self.input_collapsed = True
+
+    def expand(self, edit):
+        if self.input_collapsed:
+            self.input_collapsed = False
+            self.write_to_region(edit, "inb_input", self.cell.source)
+
     def get_input_content(self):
+        if self.input_collapsed:
+            return self.cell.source
         input_region = self.get_input_region()
         if input_region:
             return self.view.substr(input_region)
@@ -101,12 +254,13 @@ class BaseCellView(object):
 
 class CodeCellView(BaseCellView):
     def __init__(self, nbview, index, view, cell):
-        BaseCellView.__init__(self, index, view, cell)
+        BaseCellView.__init__(self, index, view, cell, nbview.positions)
         self.running = False
         self.nbview = nbview
         self.owned_regions.append("inb_output")
         self.old_is_R = self.is_R_cell()
         self.old_prompt_number = -1
+        self.reset_output_state()
 
     @property
     def prompt(self):
@@ -200,29 +354,153 @@ class CodeCellView(BaseCellView):
         self.old_is_R = self.is_R_cell()
 
         inp_reg = self.get_input_region()
-        line = self.view.line(inp_reg.begin() - 1)
-        self.view.replace(edit, line, self.get_input_prompt() % self.prompt)
+        self.replace_line(edit, inp_reg.begin() - 1, self.get_input_prompt() % self.prompt)
 
         inp_reg = self.get_input_region()
-        line = self.view.line(inp_reg.end() + 2)
-        self.view.replace(edit, line, "#/Input[%s]" % self.prompt)
+        self.replace_line(edit, inp_reg.end() + 2, "#/Input[%s]" % self.prompt)
 
         out_reg = self.get_region("inb_output")
-        line = self.view.line(out_reg.begin() - 1)
-        self.view.replace(edit, line, "#Output[%s]" % self.prompt)
-
-
+        self.replace_line(edit, out_reg.begin() - 1, "#Output[%s]" % self.prompt)
+
+    def replace_line(self, edit, pos, text):
+        line = self.view.line(pos)
+        self.view.replace(edit, line, text)
+        self.positions.edit(self.index, line.begin(), line.size(), len(text))
+
+
+
+    def reset_output_state(self):
+        # what is already in the output region, so that new output
+        # can be appended instead of rewriting the whole region
+        self.written_generation = None
+        self.written_count = 0
+        self.written_size = 0
+        self.output_truncated = False
+        self.at_line_start = True
+        self.pending_newline = False
+        # the last output written, its length in the region and the state
+        # before it, to rewrite it when it changes
+        self.last_written = None
+        self.last_length = 0
+        self.last_state = None
+
+    def indent_output(self, text):
+        """Prefix every output line with a space.
+
+        The last line break is held back until more text follows, which keeps
+        the region free of a trailing newline like write_to_region does.
+        """
+        result = []
+        for piece in text.splitlines(True):
+            if self.pending_newline:
+                result.append("\n")
+                self.pending_newline = False
+            line = piece.splitlines()[0]
+            if self.at_line_start:
+                result.append(" ")
+            result.append(line)
+            self.at_line_start = len(line) != len(piece)
+            self.pending_newline = self.at_line_start
+        return "".join(result)
+
+    def format_outputs(self, outputs):
+        result = []
+        for text in outputs:
+            self.last_written = text
+            self.last_length = 0
+            self.last_state = (self.written_size, self.output_truncated, self.at_line_start, self.pending_newline)
+            self.written_count += 1
+            if self.output_truncated:
+                continue
+            room = ipy_connection.MAX_OUTPUT_SIZE - self.written_size
+            if len(text) > room:
+                text = text[:room] + "..."
+                self.output_truncated = True
+            self.written_size += len(text)
+            text = self.indent_output(text)
+            self.last_length = len(text)
+            result.append(text)
+        return "".join(result)
+
+    def output_placeholder(self):
+        count = len(self.cell.outputs)
+        return " (%d outputs hidden)" % count if count else ""
+
+    def sync_collapsed(self, inputs):
+        BaseCellView.sync_collapsed(self, inputs)
+        region = self.get_region("inb_output")
+        if region is None:
+            return
+        shown = self.view.substr(region)
+        if _output_placeholder_re.match(shown):
+            self.output_collapsed = True
+        elif shown:
+            self.output_collapsed = False
+        # the undo may have taken back output written since, the next
+        # output is written over the whole region
+        self.reset_output_state()
+
+    def collapse(self, edit, inputs):
+        BaseCellView.collapse(self, edit, inputs)
+        if not self.output_collapsed:
+            self.output_collapsed = True
+            self.reset_output_state()
+            self.write_to_region(edit, "inb_output", self.output_placeholder())
+
+    def expand(self, edit):
+        BaseCellView.expand(self, edit)
+        if self.output_collapsed:
+            self.output_collapsed = False
+            self.output_result(edit)
 
     def output_result(self, edit):
-        output = self.cell.output
-        output = "\n".join(map(lambda s: " " + s, output.splitlines()))
-        self.write_to_region(edit, "inb_output", output)
+        if self.output_collapsed:
+            self.write_to_region(edit, "inb_output", self.output_placeholder())
+            return
+        outputs = self.cell.rendered_outputs()
+        if outputs and (self.cell.msg_id is not None):
+            self.nbview.kernel.latency.event(self.cell.msg_id, "rendered")
+        if (self.written_generation != self.cell.output_generation) or (len(outputs) < self.written_count):
+            self.reset_output_state()
+            self.written_generation = self.cell.output_generation
+            self.write_to_region(edit, "inb_output", self.format_outputs(outputs))
+            return
+
+        length = 0
+        if self.written_count and (outputs[self.written_count - 1] is not self.last_written):
+            # the last output written changed (a stream line grew), only
+            # its text at the end of the region is written again
+            length = self.last_length
+            self.written_count -= 1
+            self.written_size, self.output_truncated, self.at_line_start, self.pending_newline = self.last_state
+        elif len(outputs) == self.written_count:
+            return
+        text = self.format_outputs(outputs[self.written_count:])
+        if text or length:
+            end = self.get_region("inb_output").end()
+            self.view.set_read_only(False)
+            self.view.replace(edit, sublime.Region(end - length, end), text)
+            self.positions.edit(self.index, end - length, length, len(text))
 
     def draw(self, edit):
         BaseCellView.draw(self, edit)
         self.write_to_region(edit, "inb_input", self.cell.source)
         self.output_result(edit)
 
+    def layout_parts(self):
+        self.reset_output_state()
+        if self.output_collapsed:
+            output = self.output_placeholder()
+        else:
+            self.written_generation = self.cell.output_generation
+            output = self.format_outputs(self.cell.rendered_outputs())
+        prompt = self.prompt
+        return [(self.get_input_prompt() % prompt, None),
+                (self.shown_source(), "inb_input"),
+                ("#/Input[%s]\n\n#Output[%s]" % (prompt, prompt), None),
+                (output, "inb_output"),
+                ("#/Output", None)]
+
     def get_code(self):
         return self.get_input_content()
 
@@ -272,6 +550,12 @@ class TextCell(BaseCellView):
         BaseCellView.draw(self, edit)
         self.write_to_region(edit, "inb_input", self.cell.source)
 
+    def layout_parts(self):
+        title = self.get_cell_title()
+        return [("#" + title, None),
+                (self.shown_source(), "inb_input"),
+                ("#/" + title, None)]
+
     def get_source(self):
         return self.get_input_content()
 
@@ -288,21 +572,112 @@ class NotebookView(object):
         view.set_syntax_file("Packages/IPython Notebook/SublimeIPythonNotebook.tmLanguage")
         view.settings().set("ipython_notebook", True)
         self.cells = []
+        self.positions = ipy_positions.PositionIndex(view)
         self.notebook_id = notebook_id
-        self.kernel = create_kernel(baseurl, notebook_id)
-        self.kernel.status_callback = self.on_status
-        self.on_status("idle")
-        self.notebook = self.kernel.get_notebook()
+        self.notebook = None
         self.modified = False
-        self.show_modified_status(False)
-
-        self.set_name(self.notebook.name)
+        self.closed = False
+        # virtual rendering: only the cells near the visible region are
+        # shown in full, the ones in expanded may have to be collapsed
+        self.virtual = False
+        self.expanded = set()
+        self.watching_viewport = False
+        self.last_visible = None
+        self.viewport_change_count = None
+        # set when an undo or redo is about to run: it can bring back what
+        # the viewport changes replaced, see sync_collapsed
+        self.undoing = False
+        # work left from selection and modification events, done when they stop
+        self.idle = IdleTask(self.on_idle)
+        self.input_cell = -1
+        self.highlighted = None
+        self.check_R_cells = set()
+        self.batch = None
+        # the kernel is started and the notebook is fetched at the same time,
+        # the notebook is rendered as soon as it arrives
+        self.session, created = sessions.acquire(
+            baseurl, notebook_id, lambda: create_kernel(baseurl, notebook_id, autostart=False), self.on_status)
+        self.kernel = self.session.kernel
+        # the other views of the notebook have their own copy of it, so they
+        # save on their own and only the first one keeps the edit journal
+        self.saver = ipy_connection.SaveWorker(self.kernel)
+        self.owns_journal = self.session.claim_journal(self)
+        self.seen_saves = 0
+        if created:
+            self.session.on_status("starting")
+            self.kernel.start_kernel_async()
+        _thread.start_new_thread(self.load_notebook, ())
+
+    def load_notebook(self):
+        try:
+            notebook = self.kernel.get_notebook()
+        except Exception as e:
+            print("Failed to load notebook", self.notebook_id)
+            print(e)
+            return
 
+        configure_notebook(notebook)
+
+        journal = create_journal(self.baseurl, self.notebook_id) if self.owns_journal else None
+        found = None
+        changed_on_server = False
+        if journal is not None:
+            found = ipy_journal.read_journal(journal.path)
+            if found and not found[1] and (found[0][0] == "server"):
+                found = None  # nothing was changed after the last save
+            if found and (found[0][0] == "server") and found[0][1]:
+                changed_on_server = found[0][1] != notebook.content_hash()
+
+        def on_loaded():
+            nb = None
+            if found:
+                nb = self.recover_notebook(notebook, found[0], found[1], changed_on_server)
+            self.notebook = nb or notebook
+            self.seen_saves = self.session.saves
+            if journal is not None:
+                self.notebook.journal = journal
+                if nb is None:
+                    journal.reset(None)
+                else:
+                    self.notebook.compact_journal(force=True)
+            self.show_modified_status(False)
+            self.set_name(self.notebook.name)
+            self.view.run_command("inb_render_notebook")
+            if nb is not None:
+                sublime.set_timeout(lambda: self.set_modified(True), 0)
+        sublime.set_timeout(on_loaded, 0)
+
+    def recover_notebook(self, notebook, base, records, changed_on_server):
+        """Offer to apply the unsaved changes found in the edit journal,
+        return the recovered notebook or None"""
+        message = "Notebook %s has unsaved changes from an earlier session.\n" % notebook.name
+        if changed_on_server:
+            message += "It was saved elsewhere since, recovering may lose those changes.\n"
+        if not sublime.ok_cancel_dialog(message + "Recover them?", "Recover"):
+            return None
+        if base[0] == "snapshot":
+            notebook = ipy_connection.Notebook(base[1])
+            configure_notebook(notebook)
+        applied = notebook.apply_journal(records)
+        print("Recovered notebook %s: %d of %d changes" % (self.notebook_id, applied, len(records)))
+        return notebook
+
+    def close(self):
+        self.closed = True
+        sessions.release(self.session, self.on_status)
+        if (self.notebook is not None) and (self.notebook.journal is not None):
+            # keep the journal only if there are unsaved changes
+            self.notebook.journal.close(remove=not (self.modified or self.notebook.dirty))
+        self.session.release_journal(self)
 
     def get_name(self):
+        if self.notebook is None:
+            return ""
         return self.notebook.name
 
     def set_name(self, new_name):
+        if self.notebook is None:
+            return
         self.notebook.name = new_name
         self.view.set_name("IPy Notebook - " + self.notebook.name)
 
@@ -311,27 +686,50 @@ class NotebookView(object):
 
     def on_sel_modified(self):
         readonly = True
-        regset = self.view.get_regions("inb_input")
 
         first_cell_index = -1
         for s in self.view.sel():
-            readonly = True
-            for i, reg in enumerate(regset):
-                reg = sublime.Region(reg.begin()+1, reg.end()-1)
-                if reg.contains(s):
-                    if first_cell_index < 0:
-                        first_cell_index = i
-                    readonly = False
-                    break
+            i = self.positions.find_input(s.begin(), s.end())
+            readonly = i < 0
             if readonly:
                 break
-
-        if first_cell_index >= 0:
-            self.highlight_cell(regset[first_cell_index])
-        else:
-            self.view.erase_regions("inb_highlight")
-
-        self.view.set_read_only(readonly)
+            if first_cell_index < 0:
+                first_cell_index = i
+            if (i < len(self.cells)) and self.cells[i].input_collapsed:
+                readonly = True
+                break
+        # edits the user makes are put down to this cell
+        self.positions.active = first_cell_index
+        self.input_cell = first_cell_index
+
+        # the guard has to be in place before the next key press
+        if self.view.is_read_only() != readonly:
+            self.view.set_read_only(readonly)
+        self.idle.request()
+
+    def on_idle(self):
+        if self.closed or (self.notebook is None):
+            return  # events can come in while the notebook is still loading
+        cells, self.check_R_cells = self.check_R_cells, set()
+        for cell in cells:
+            if (cell.index < len(self.cells)) and (self.cells[cell.index] is cell):
+                cell.check_R()
+
+        if self.notebook.journal is not None:
+            # typed source reaches the model (and the journal) only here, on run or on save
+            self.update_notebook_from_buffer()
+            self.notebook.compact_journal()
+
+        region = self.positions.region(self.input_cell, "inb_input")
+        if region != self.highlighted:
+            self.highlighted = region
+            if region is not None:
+                self.highlight_cell(sublime.Region(*region))
+            else:
+                self.view.erase_regions("inb_highlight")
+
+        if self.virtual:
+            self.check_viewport()
 
     def show_modified_status(self, val):
         if val:
@@ -348,17 +746,32 @@ class NotebookView(object):
             self.show_modified_status(new_val)
         self.modified = new_val
 
+    def on_text_command(self, command_name):
+        if command_name in UNDO_COMMANDS:
+            self.undoing = True
+
     def on_modified(self):
+        if self.notebook is None:
+            return
+        if self.viewport_change_count == self.view.change_count():
+            return  # only cells were expanded or collapsed
+        if self.undoing:
+            self.undoing = False
+            self.sync_collapsed()
         self.set_modified(True)
 
-        regset = self.view.get_regions("inb_input")
-
+        found = False
         for s in self.view.sel():
-            for i, reg in enumerate(regset):
-                reg = sublime.Region(reg.begin()+1, reg.end()-1)
-                if reg.contains(s) and (i < len(self.cells)):
-                    self.cells[i].check_R()
-                    break
+            i = self.positions.find_input(s.begin(), s.end())
+            if 0 <= i < len(self.cells):
+                self.cells[i].dirty = True
+                self.check_R_cells.add(self.cells[i])
+                found = True
+        if not found:
+            # can't tell where the change was (undo, for one), check every cell
+            for cell in self.cells:
+                cell.dirty = True
+        self.idle.request()
 
     def highlight_cell(self, input_region):
         reg = self.view.line(input_region.begin()-2)
@@ -368,9 +781,10 @@ class NotebookView(object):
     def on_backspace(self):
         s = self.view.sel()[0]
 
-        regset = self.view.get_regions("inb_input")
-        for reg in regset:
-            reg = sublime.Region(reg.begin()+2, reg.end())
+        i = self.positions.find(s.begin(), s.end())
+        reg = self.positions.region(i, "inb_input")
+        if reg is not None:
+            reg = sublime.Region(reg[0]+2, reg[1])
             if reg.contains(s):
                 self.view.run_command("left_delete")
                 return
@@ -385,6 +799,7 @@ class NotebookView(object):
             start = view.size()
 
         self.view.set_read_only(False)
+        self.positions.invalidate()
         start = start + view.insert(edit, start, self.get_cell_separator())
         end = start + view.insert(edit, start, "\n\n")
 
@@ -422,6 +837,53 @@ class NotebookView(object):
         if not inplace:
             self.move_to_cell(False)
 
+    def run_cells(self, which, stop_on_error=None):
+        """Run all cells, the ones above the current cell or the current
+        one and the ones below it, as one batch"""
+        if self.notebook is None:
+            return
+        if (self.batch is not None) and not self.batch.done:
+            print("Cells are already running")
+            return
+        if which == "all":
+            cell_views = self.cells
+        else:
+            cell_index = self.get_current_cell_index()
+            if cell_index < 0:
+                return
+            cell_views = self.cells[:cell_index] if which == "above" else self.cells[cell_index:]
+
+        cells = []
+        for cell_view in cell_views:
+            if (not isinstance(cell_view, CodeCellView)) or cell_view.running:
+                continue
+            cell_view.running = True
+            cell_view.update_code()
+            cells.append(cell_view.cell)
+        if not cells:
+            return
+
+        settings = get_settings()
+        if stop_on_error is None:
+            stop_on_error = settings.get("run_stop_on_error", True)
+        self.batch = ipy_connection.RunBatch(self.kernel, cells, stop_on_error=stop_on_error,
+                                             depth=settings.get("run_pipeline_depth", ipy_connection.RUN_PIPELINE_DEPTH),
+                                             done_callback=self.on_batch_done)
+        self.view.set_status("RunStatus", "running %d cells" % len(cells))
+        self.batch.start()
+
+    def cancel_run(self, abandon=False):
+        if self.batch is not None:
+            self.batch.cancel(abandon)
+
+    def on_batch_done(self, batch):
+        for cell in batch.cancelled:
+            if cell.cell_view:
+                cell.cell_view.running = False
+        summary = batch.summary()
+        print("Notebook %s: %s" % (self.notebook_id, summary))
+        sublime.set_timeout(lambda: self.view.set_status("RunStatus", summary), 0)
+
     def get_cell_by_index(self, cell_index):
         res = self.cells[cell_index]
         res.view = self.view
@@ -432,52 +894,191 @@ class NotebookView(object):
         if len(sel) > 1:
             return -1
         sel = self.view.sel()[0]
-        regions = self.view.get_regions("inb_cells")
-        return self.find_cell_by_selection(sel, regions)
+        return self.find_cell_by_selection(sel)
 
-    def find_cell_by_selection(self, sel, regions):
-        for i, reg in enumerate(regions):
-            if reg.contains(sel):
-                return i
-        return -1
+    def find_cell_by_selection(self, sel):
+        return self.positions.find(sel.begin(), sel.end())
 
     def save_notebook(self):
-        self.kernel.save_notebook(self.notebook)
-        self.set_modified(False)
+        if self.notebook is None:
+            return
+        self.update_notebook_from_buffer()
+        if not self.notebook.dirty:
+            self.set_modified(False)
+            return
+        if self.session.saves != self.seen_saves:
+            message = "Notebook %s was saved from another view since this one was loaded or saved.\n" % self.notebook.name
+            if not sublime.ok_cancel_dialog(message + "Saving overwrites those changes. Save anyway?", "Save"):
+                return
+        self.view.set_status("SaveStatus", "saving...")
+        self.saver.request(self.notebook, self.on_saved)
+
+    def on_saved(self, size, duration, error):
+        def update():
+            if error is not None:
+                status = "save failed"
+            elif size is None:
+                status = "unchanged, not saved"
+            else:
+                status = "saved %.1f KB in %.2fs" % (size / 1024.0, duration)
+                self.session.saves += 1
+                self.seen_saves = self.session.saves
+            self.view.set_status("SaveStatus", status)
+            if (error is None) and not self.notebook.dirty and not any(cell.dirty for cell in self.cells):
+                self.set_modified(False)
+        sublime.set_timeout(update, 0)
 
     def render_notebook(self, edit):
+        if self.notebook is None:
+            return
+        with self.kernel.timer.measure("render"):
+            self.draw_notebook(edit)
+
+    def draw_notebook(self, edit):
+        """Lay out all cells in memory, then fill the buffer with a single
+        insert and one add_regions per region name"""
         self.cells = []
         self.view.erase_regions("inb_cells")
         self.view.erase_regions("inb_input")
         self.view.erase_regions("inb_output")
+        self.positions.reset([], [], [], self.view.size())
+
+        settings = get_settings()
+        threshold = settings.get("virtual_render_threshold", VIRTUAL_RENDER_THRESHOLD)
+        self.virtual = 0 < threshold < self.notebook.cell_count
+        self.virtual_margin = settings.get("virtual_render_margin", VIRTUAL_RENDER_MARGIN)
+        self.virtual_inputs = settings.get("virtual_render_inputs", False)
+        self.expanded = set()
+        self.highlighted = None
+
+        pieces = []
+        regions = {"inb_cells": [], "inb_input": [], "inb_output": []}
+        pos = 0
+        separator = self.get_cell_separator()
         for i in range(self.notebook.cell_count):
-            self.insert_cell_field(edit, i)
-            cell = self.notebook.get_cell(i)
-            cell_view = self.create_cell_view(i, self.view, cell)
+            cell_view = self.create_cell_view(i, self.view, self.notebook.get_cell(i))
             self.cells.append(cell_view)
+            if self.virtual and (i > 2 * self.virtual_margin):
+                # the first cells are shown, the viewport check takes it from there
+                cell_view.input_collapsed = self.virtual_inputs
+                cell_view.output_collapsed = isinstance(cell_view, CodeCellView)
+            else:
+                self.expanded.add(cell_view)
+            pieces.append(separator)
+            pos = cell_view.layout(pos + len(separator), pieces, regions)
 
-        regions = self.view.get_regions("inb_cells")
-        assert len(self.cells) == len(regions)
-
-        for cell in self.cells:
-            cell.draw(edit)
+        self.view.set_read_only(False)
+        self.view.erase(edit, sublime.Region(0, self.view.size()))
+        self.view.insert(edit, 0, "".join(pieces))
+        self.view.add_regions("inb_cells", regions["inb_cells"], "", "", cell_draw_style)
+        self.view.add_regions("inb_input", regions["inb_input"], "source.python", "", input_draw_style)
+        self.view.add_regions("inb_output", regions["inb_output"], "string", "", output_draw_style)
+        self.positions.reset(regions["inb_cells"], regions["inb_input"], regions["inb_output"], pos)
 
         if len(self.cells) > 0:
             self.cells[0].select()
 
         sublime.set_timeout(lambda : self.set_modified(False), 0)
+        if self.virtual and not self.watching_viewport:
+            self.last_visible = None
+            self.watch_viewport()
+
+    def watch_viewport(self):
+        # Sublime Text has no event for scrolling, so the viewport is polled
+        if self.closed or not self.virtual:
+            self.watching_viewport = False
+            return
+        self.watching_viewport = True
+        self.check_viewport()
+        sublime.set_timeout(self.watch_viewport, VIEWPORT_POLL_INTERVAL)
+
+    def viewport_window(self):
+        """Indexes of the first and the last cell to show in full"""
+        visible = self.view.visible_region()
+        first = self.positions.nearest(visible.begin())
+        last = self.positions.nearest(visible.end())
+        return first - self.virtual_margin, last + self.virtual_margin
+
+    def check_viewport(self):
+        visible = self.view.visible_region()
+        key = (visible.a, visible.b, self.view.size())
+        if key == self.last_visible:
+            return
+        self.last_visible = key
+        first, last = self.viewport_window()
+        outside = [cell for cell in self.expanded
+                   if not (first - self.virtual_margin <= cell.index <= last + self.virtual_margin)]
+        inside = [cell for cell in self.cells[max(first, 0):last + 1] if cell.collapsed]
+        if outside or inside:
+            self.view.run_command("inb_update_viewport")
+
+    def update_viewport(self, edit):
+        """Expand the cells near the visible region and collapse the ones
+        that are (by a margin) far from it"""
+        if not self.virtual:
+            return
+        first, last = self.viewport_window()
+        anchor = self.get_viewport_anchor(first + self.virtual_margin)
+        for cell in list(self.expanded):
+            if not (first - self.virtual_margin <= cell.index <= last + self.virtual_margin):
+                cell.collapse(edit, self.virtual_inputs)
+                self.expanded.discard(cell)
+        for cell in self.cells[max(first, 0):last + 1]:
+            if cell.collapsed:
+                cell.expand(edit)
+            self.expanded.add(cell)
+        self.set_viewport_anchor(anchor)
+        self.viewport_change_count = self.view.change_count()
+
+    def get_viewport_anchor(self, cell_index):
+        """Where the first visible cell is on the screen"""
+        region = self.positions.region(cell_index, "inb_cells")
+        if region is None:
+            return None
+        y = self.view.text_to_layout(region[0])[1] - self.view.viewport_position()[1]
+        return cell_index, y
+
+    def set_viewport_anchor(self, anchor):
+        """Scroll the cell of the anchor back to where it was, text added or
+        removed above it would move it otherwise"""
+        if anchor is None:
+            return
+        cell_index, y = anchor
+        region = self.positions.region(cell_index, "inb_cells")
+        if region is None:
+            return
+        x = self.view.viewport_position()[0]
+        self.view.set_viewport_position((x, self.view.text_to_layout(region[0])[1] - y), False)
+
+    def sync_collapsed(self):
+        """Undo and redo take back or redo the placeholders of collapsed
+        cells too (a plugin cannot keep its edits out of the undo history).
+        The flags are set from the buffer before any of it is read back
+        into the cells."""
+        if not self.virtual:
+            return
+        for cell in self.cells:
+            cell.sync_collapsed(self.virtual_inputs)
+            if cell.collapsed:
+                self.expanded.discard(cell)
+            else:
+                self.expanded.add(cell)
 
     def update_notebook_from_buffer(self):
         for cell in self.cells:
-            cell.update_code()
+            if cell.dirty:
+                cell.dirty = False
+                cell.update_code()
 
     def restart_kernel(self):
+        self.cancel_run(abandon=True)
         for cell in self.cells:
             if isinstance(cell, CodeCellView):
                 cell.running = False
         self.kernel.restart_kernel()
 
     def shutdown_kernel(self):
+        self.cancel_run(abandon=True)
         for cell in self.cells:
             if isinstance(cell, CodeCellView):
                 cell.running = False
@@ -486,6 +1087,10 @@ class NotebookView(object):
     def on_status(self, execution_state):
         def set_status():
             self.view.set_status("ExecutionStatus", "kernel: " + execution_state)
+            if (execution_state == "idle") and get_settings().get("show_latency_status", True):
+                summary = self.kernel.latency.summary()
+                if summary:
+                    self.view.set_status("LatencyStatus", summary)
         sublime.set_timeout(set_status, 0)
 
     def handle_completions(self, view, prefix, locations):
@@ -500,8 +1105,14 @@ class NotebookView(object):
         sel = sel[0]
         line = view.substr(view.line(sel))
         row, col = view.rowcol(sel.begin())
-        compl = self.kernel.get_completitions(line, col, timeout=0.7)
-
+        compl = self.kernel.completer.lookup(line, col)
+        if compl is None:
+            # ask the kernel without blocking, the completion popup is
+            # reopened when the answer arrives
+            if self.kernel.running:
+                self.kernel.completer.request(line, col, lambda matches:
+                                              sublime.set_timeout(lambda: self.on_completions_ready(sel.begin(), line), 0))
+            return None
 
         if len(compl) > 0:
             def get_last_word(s): # needed for file/directory completion
@@ -514,6 +1125,14 @@ class NotebookView(object):
         else:
             return None
 
+    def on_completions_ready(self, pos, line):
+        sel = self.view.sel()
+        if (len(sel) != 1) or (sel[0].begin() != pos) or (self.view.substr(self.view.line(pos)) != line):
+            return  # the caret moved on, the answer is cached for later
+        self.view.run_command("hide_auto_complete")
+        self.view.run_command("auto_complete", {"disable_auto_insert": True,
+                                                "next_completion_if_showing": False})
+
     def delete_current_cell(self, edit):
         cell_index = self.get_current_cell_index()
         if cell_index < 0:
@@ -522,6 +1141,7 @@ class NotebookView(object):
         self.update_notebook_from_buffer()
         self.notebook.delete_cell(cell_index)
         self.cells[cell_index].teardown(edit)
+        self.expanded.discard(self.cells[cell_index])
         del self.cells[cell_index]
         for cell in self.cells:
             if cell.index >= cell_index:
@@ -529,6 +1149,7 @@ class NotebookView(object):
 
         regions = self.view.get_regions("inb_cells")
         reg = regions[cell_index]
+        self.positions.invalidate()
         self.view.erase(edit, self.view.full_line(sublime.Region(reg.a, reg.b-1)))
         regions = self.view.get_regions("inb_cells")
         del regions[cell_index]
@@ -560,6 +1181,7 @@ class NotebookView(object):
         new_view = self.create_cell_view(cell_index, self.view, new_cell)
         self.insert_cell_field(edit, cell_index)
         self.cells.insert(cell_index, new_view)
+        self.expanded.add(new_view)
         new_view.draw(edit)
         new_view.select()
 
@@ -625,7 +1247,9 @@ class NotebookView(object):
         new_cell.source = src
         new_view = self.create_cell_view(cell_index, self.view, new_cell)
         self.cells[cell_index].teardown(edit)
+        self.expanded.discard(self.cells[cell_index])
         self.cells[cell_index] = new_view
+        self.expanded.add(new_view)
         new_view.draw(edit)
         new_view.select()
 
@@ -633,7 +1257,54 @@ class NotebookView(object):
         if cell.cell_type == "code":
             return CodeCellView(self, index, view, cell)
         else:
-            return TextCell(index, view, cell)
+            return TextCell(index, view, cell, self.positions)
+
+    def page_output(self):
+        cell_index = self.get_current_cell_index()
+        if (cell_index < 0) or not isinstance(self.cells[cell_index], CodeCellView):
+            return
+        cell = self.cells[cell_index].cell
+        count = cell.output_page_count()
+        if count == 1:
+            self.on_pager(cell.read_output_page(0))
+            return
+
+        def on_done(page):
+            if page >= 0:
+                self.on_pager(cell.read_output_page(page))
+        pages = ["Output page %d of %d" % (i + 1, count) for i in range(count)]
+        self.view.window().show_quick_panel(pages, on_done)
+
+    def open_images(self):
+        cell_index = self.get_current_cell_index()
+        if (cell_index < 0) or not isinstance(self.cells[cell_index], CodeCellView):
+            return
+        import webbrowser
+        from urllib.request import pathname2url
+        blobs = ipy_blobs.get_blob_store()
+        for output in self.cells[cell_index].cell.outputs:
+            for key in ipy_blobs.blob_keys:
+                if isinstance(output.get(key), ipy_blobs.BlobRef):
+                    path = blobs.export_file(output[key], key)
+                    webbrowser.open("file:" + pathname2url(path))
+
+    def show_kernel_stats(self):
+        stats = self.kernel.stats()
+        stats.update(self.saver.stats())
+        stats.update(sessions.stats())
+        stats["session_views"] = len(self.session.listeners)
+        if (self.notebook is not None) and (self.notebook.journal is not None):
+            stats.update(self.notebook.journal.stats())
+        stats.update(self.positions.stats())
+        stats["view_events"] = self.idle.requests
+        stats["view_idle_runs"] = self.idle.runs
+        if self.batch is not None:
+            stats["run_batch"] = self.batch.summary() if self.batch.done else "running"
+        lines = ["%s: %s" % (key, stats[key]) for key in sorted(stats)]
+        self.on_pager("\n".join(lines) + "\n")
+
+    def show_latency(self):
+        self.on_pager(self.kernel.latency.dump())
 
     def on_pager(self, text):
         text = re.sub("\x1b[^m]*m", "", text)
@@ -677,6 +1348,7 @@ class NotebookViewManager(object):
     def on_close(self, view):
         id = view.id()
         if id in self.views:
+            self.views[id].close()
             del self.views[id]
 
 manager = NotebookViewManager()
@@ -16,6 +16,11 @@ class SublimeINListener(sublime_plugin.EventListener):
         if nbview:
             nbview.on_sel_modified()
 
+    def on_text_command(self, view, command_name, args):
+        nbview = manager.get_nb_view(view)
+        if nbview:
+            nbview.on_text_command(command_name)
+
     def on_modified(self, view):
         nbview = manager.get_nb_view(view)
         if nbview:
@@ -106,8 +111,6 @@ class InbListNotebooksCommand(sublime_plugin.WindowCommand):
                 return
             manager.create_nb_view(view, new_nb_id, self.baseurl)
 
-        view.run_command("inb_render_notebook")
-
 
 class SetPagerTextCommand(sublime_plugin.TextCommand):
     """command to set the text in the pop-up pager"""
@@ -131,11 +134,38 @@ class InbInterruptKernelCommand(sublime_plugin.TextCommand):
             nbview.kernel.interrupt_kernel()
 
 
+class InbPageOutputCommand(sublime_plugin.TextCommand):
+    def run(self, edit):
+        nbview = manager.get_nb_view(self.view)
+        if nbview:
+            nbview.page_output()
+
+
+class InbOpenImagesCommand(sublime_plugin.TextCommand):
+    def run(self, edit):
+        nbview = manager.get_nb_view(self.view)
+        if nbview and nbview.notebook:
+            nbview.open_images()
+
+
+class InbShowKernelStatsCommand(sublime_plugin.TextCommand):
+    def run(self, edit):
+        nbview = manager.get_nb_view(self.view)
+        if nbview and nbview.kernel:
+            nbview.show_kernel_stats()
+
+
+class InbShowLatencyCommand(sublime_plugin.TextCommand):
+    def run(self, edit):
+        nbview = manager.get_nb_view(self.view)
+        if nbview:
+            nbview.show_latency()
+
+
 class InbSaveNotebookCommand(sublime_plugin.TextCommand):
     def run(self, edit):
         nbview = manager.get_nb_view(self.view)
         if nbview:
-            nbview.update_notebook_from_buffer()
             nbview.save_notebook()
 
     def description(self):
@@ -182,6 +212,13 @@ class InbInsertOutputCommand(sublime_plugin.TextCommand):
         cell.output_result(edit)
 
 
+class InbUpdateViewportCommand(sublime_plugin.TextCommand):
+    def run(self, edit):
+        nbview = manager.get_nb_view(self.view)
+        if nbview:
+            nbview.update_viewport(edit)
+
+
 class InbRunInNotebookCommand(sublime_plugin.TextCommand):
     def run(self, edit, inplace):
         nbview = manager.get_nb_view(self.view)
@@ -189,6 +226,20 @@ class InbRunInNotebookCommand(sublime_plugin.TextCommand):
             nbview.run_cell(edit, inplace)
 
 
+class InbRunCellsCommand(sublime_plugin.TextCommand):
+    def run(self, edit, which="all", stop_on_error=None):
+        nbview = manager.get_nb_view(self.view)
+        if nbview:
+            nbview.run_cells(which, stop_on_error)
+
+
+class InbCancelRunCommand(sublime_plugin.TextCommand):
+    def run(self, edit):
+        nbview = manager.get_nb_view(self.view)
+        if nbview:
+            nbview.cancel_run()
+
+
 class InbDeleteCurrentCellCommand(sublime_plugin.TextCommand):
     def run(self, edit):
         nbview = manager.get_nb_view(self.view)
@@ -249,7 +300,7 @@ class InbOpenAsIpynbCommand(sublime_plugin.WindowCommand):
     def run(self):
         view = self.window.active_view()
         nbview = manager.get_nb_view(view)
-        if nbview:
+        if nbview and nbview.notebook:
             s = str(nbview.notebook)
             new_view = self.window.new_file()
             new_view.run_command('inb_insert_string', {'s': s})